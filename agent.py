@@ -0,0 +1,88 @@
+"""
+Push mode: a small shell/awk loop on the modem that streams the sensor values instead of being polled.
+
+The loop is installed once per connection. Every interval it runs the ethtool and libmapi_dsl_cli commands
+and reduces their output with awk to one record with the values of FIELDS in fixed order:
+
+    @D1|<uptime>|<value 1>|<value 2>|...
+
+If none of the values changed since the last record, only "@K1|<uptime>" is sent, which also tells the controller
+that the modem is still there. Missing values are empty. A full record can be requested at any time with
+once(), e.g. for event-triggered refreshes.
+"""
+
+from sensors import SENSORS
+
+RECORD = "@D1|"
+KEEPALIVE = "@K1|"
+PIDFILE = "/tmp/dslagent.pid"
+AWKFILE = "/tmp/dslagent.awk"
+# longest line sent to the console including the newline. The awk program alone is about 1.4 kB, so it is
+# written to a file in pieces instead of being passed on one line
+MAX_LINE = 200
+UPTIME = "Modem Uptime"
+
+# the uptime changes all the time, it is sent separately so unchanged records can be skipped
+FIELDS = tuple(linestart for linestart in SENSORS if linestart != UPTIME)
+assert not any(char in linestart for char in "',\"" for linestart in FIELDS)
+
+
+def _program() -> str:
+    """
+    awk program that prints "|<value 1>|<value 2>|..." for the lines starting with one of FIELDS
+    :return:
+    """
+    return (
+        'BEGIN{n=split("' + ",".join(FIELDS) + '",P,",")}'
+        '{l=$0;sub(/^[ \\t]+/,"",l);sub(/[ \\t\\r]+$/,"",l);'
+        'for(i=1;i<=n;i++)if(index(l,P[i])==1){v=l;sub(/^[^:]*:[ \\t]*/,"",v);gsub(/\\|/,"/",v);V[i]=v;break}}'
+        'END{for(i=1;i<=n;i++)printf "|%s",V[i];print ""}'
+    )
+
+
+def install(interval: float, commands: list) -> bytes:
+    """
+    Shell commands that define the agent functions and start the loop, replacing a loop that is still running
+    :param interval: seconds between two records
+    :param commands: shell commands whose output contains the values
+    :return:
+    """
+    program = _program()
+    chunk = MAX_LINE - len(f"printf '%s' '' >>{AWKFILE}\n")
+    chunks = [program[start:start + chunk] for start in range(0, len(program), chunk)]
+    fields = "{ " + "; ".join(commands) + "; } 2>/dev/null | awk -f " + AWKFILE
+    script = (
+        f": >{AWKFILE}\n"
+        + "".join(f"printf '%s' '{chunk}' >>{AWKFILE}\n" for chunk in chunks)
+        + f"dslagent_fields() {{ {fields}; }}\n"
+        f'dslagent_once() {{ read u _ </proc/uptime; echo "{RECORD}$u$(dslagent_fields)"; }}\n'
+        f'dslagent_loop() {{ p=; while :; do r=$(dslagent_fields); read u _ </proc/uptime; '
+        f'if [ "$r" != "$p" ]; then echo "{RECORD}$u$r"; p=$r; else echo "{KEEPALIVE}$u"; fi; '
+        f'sleep {interval:g}; done; }}\n'
+        f"kill $(cat {PIDFILE} 2>/dev/null) 2>/dev/null; dslagent_loop </dev/null & echo $! >{PIDFILE}\n"
+    )
+    if any(len(line) >= MAX_LINE for line in script.split("\n")):
+        raise ValueError("Agent commands are too long for the console")
+    return script.encode()
+
+
+def once() -> bytes:
+    return b"dslagent_once\n"
+
+
+def stop() -> bytes:
+    return f"kill $(cat {PIDFILE} 2>/dev/null) 2>/dev/null; rm -f {PIDFILE} {AWKFILE}\n".encode()
+
+
+def parseRecord(line: str) -> tuple:
+    """
+    Split a record into its values
+    :param line:
+    :return: (uptime, {linestart: value} or None for a keepalive)
+    """
+    parts = line.split("|")
+    if line.startswith(KEEPALIVE) and len(parts) == 2:
+        return parts[1], None
+    if line.startswith(RECORD) and len(parts) == len(FIELDS) + 2:
+        return parts[1], {linestart: value for linestart, value in zip(FIELDS, parts[2:]) if value}
+    raise ValueError(f"Malformed agent record with {len(parts)} fields")
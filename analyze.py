@@ -0,0 +1,249 @@
+"""
+Offline analysis of the sensor history written by history.py.
+
+The column files are memory-mapped, only the rows inside the requested time range are touched, and all
+statistics are computed with NumPy on whole arrays. Examples:
+
+    python3 analyze.py /var/lib/dsl-modem/history/ columns
+    python3 analyze.py /var/lib/dsl-modem/history/ percentiles ds_current_data_rate --every day --days 90 -p 5 50
+    python3 analyze.py /var/lib/dsl-modem/history/ resample near-end_xdsl_cv-crc-8_anomalies --every hour
+    python3 analyze.py /var/lib/dsl-modem/history/ retrains near-end_xdsl_cv-crc-8_anomalies --window 6 --format json
+
+Counters are turned into increments per row first (a counter that goes down was reset by a modem restart), so
+aggregating them gives e.g. CRC errors per hour.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from history import SUFFIX, TIME_COLUMN, COUNTERS
+
+PERIODS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+}
+
+SHOWTIME = (0x0800, 0x0801)
+LINK_STATE_COLUMN = "dsl_link_state"
+
+
+def listColumns(directory: str) -> list:
+    return sorted(name[:-len(SUFFIX)] for name in os.listdir(directory) if name.endswith(SUFFIX))
+
+
+def loadColumns(directory: str, columns: list, since: float = None, until: float = None) -> dict:
+    """
+    Memory-map the time and the given columns, restricted to a time range
+    :param directory:
+    :param columns:
+    :param since: first timestamp to include
+    :param until: first timestamp to exclude
+    :return: {column: array}, all of the same length
+    """
+    mapped = {}
+    for column in (TIME_COLUMN,) + tuple(columns):
+        filename = os.path.join(directory, column + SUFFIX)
+        if not os.path.exists(filename):
+            raise ValueError(f"No column {column} in {directory}")
+        mapped[column] = np.memmap(filename, dtype=np.float64, mode="r") if os.path.getsize(filename) else np.empty(0)
+    # the writer appends the time last, so the time column is never longer than the others
+    timestamps = mapped[TIME_COLUMN]
+    first = np.searchsorted(timestamps, since) if since is not None else 0
+    last = np.searchsorted(timestamps, until) if until is not None else len(timestamps)
+    return {column: values[first:last] for column, values in mapped.items()}
+
+
+def increments(values):
+    """
+    Per-row increase of a counter, a decrease means the counter was reset and counts from zero again
+    :param values:
+    :return:
+    """
+    values = np.asarray(values)
+    delta = np.diff(values, prepend=values[:1])
+    reset = delta < 0
+    delta[reset] = values[reset]
+    return delta
+
+
+def prepare(column: str, values):
+    return increments(values) if column in COUNTERS else np.asarray(values)
+
+
+def buckets(timestamps, period: float):
+    """
+    Number of the period every timestamp falls into, periods start at local midnight
+    :param timestamps:
+    :param period: seconds
+    :return:
+    """
+    offset = time.localtime(timestamps[-1]).tm_gmtoff if len(timestamps) else 0
+    return np.floor((timestamps + offset) / period).astype(np.int64), offset
+
+
+def groups(keys, values):
+    """
+    Sort the non-NaN values by key and split them into groups
+    :param keys: group of every value
+    :param values:
+    :return: (keys of the groups, start of every group, size of every group, sorted values)
+    """
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[:1] - 1)) if len(keys) else np.empty(0, dtype=np.int64)
+    sizes = np.diff(np.append(starts, len(keys)))
+    return keys[starts], starts, sizes, values
+
+
+def groupPercentile(starts, sizes, values, percent: float):
+    """
+    Linear interpolation between the closest ranks, for all groups at once
+    :param starts:
+    :param sizes:
+    :param values: sorted within every group
+    :param percent:
+    :return:
+    """
+    position = starts + (sizes - 1) * percent / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def aggregate(keys, values, percentiles: list = (), counter: bool = False) -> tuple:
+    """
+    Statistics of the values per key
+    :param keys:
+    :param values:
+    :param percentiles:
+    :param counter: the values are increments, also report their sum
+    :return: (keys, {statistic: array})
+    """
+    keys, starts, sizes, values = groups(keys, values)
+    stats = {"count": sizes}
+    if len(starts):
+        sums = np.add.reduceat(values, starts)
+        if counter:
+            stats["sum"] = sums
+        stats["mean"] = sums / sizes
+        stats["min"] = values[starts]
+        stats["max"] = values[starts + sizes - 1]
+    else:
+        for statistic in (("sum",) if counter else ()) + ("mean", "min", "max"):
+            stats[statistic] = np.empty(0)
+    for percent in percentiles:
+        stats[f"p{percent:g}"] = groupPercentile(starts, sizes, values, percent) if len(starts) else np.empty(0)
+    return keys, stats
+
+
+def retrainTimes(timestamps, linkstate):
+    """
+    Times at which the line left showtime
+    :param timestamps:
+    :param linkstate:
+    :return:
+    """
+    showtime = np.isin(linkstate, SHOWTIME)
+    dropped = np.flatnonzero(showtime[:-1] & ~showtime[1:]) + 1
+    return timestamps[dropped]
+
+
+def formatTime(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def rows(keys, stats: dict, label: str, labels) -> list:
+    result = []
+    for index in range(len(keys)):
+        row = {label: labels[index]}
+        for statistic, values in stats.items():
+            value = values[index].item()
+            row[statistic] = round(value, 3) if isinstance(value, float) else value
+        result.append(row)
+    return result
+
+
+def commandPercentiles(data: dict, args) -> list:
+    args.percentiles = args.percentiles or [5, 50, 95]
+    return commandResample(data, args)
+
+
+def commandResample(data: dict, args) -> list:
+    timestamps = data[TIME_COLUMN]
+    if not len(timestamps):
+        return []
+    period = PERIODS[args.every]
+    keys, offset = buckets(timestamps, period)
+    keys, stats = aggregate(keys, prepare(args.column, data[args.column]), args.percentiles or (),
+                            counter=args.column in COUNTERS)
+    return rows(keys, stats, "start", [formatTime(key * period - offset) for key in keys.tolist()])
+
+
+def commandRetrains(data: dict, args) -> list:
+    timestamps = data[TIME_COLUMN]
+    if LINK_STATE_COLUMN not in data or not len(timestamps):
+        return []
+    period = PERIODS[args.every]
+    values = prepare(args.column, data[args.column])
+    result = []
+    for retrain in retrainTimes(timestamps, data[LINK_STATE_COLUMN]).tolist():
+        first, last = np.searchsorted(timestamps, (retrain - args.window * period, retrain + args.window * period))
+        # windows are numbered relative to the retrain, -1 is the period right before it
+        keys = np.floor((timestamps[first:last] - retrain) / period).astype(np.int64)
+        keys, stats = aggregate(keys, values[first:last], args.percentiles or (), counter=args.column in COUNTERS)
+        for row in rows(keys, stats, "offset", keys.tolist()):
+            result.append(dict(retrain=formatTime(retrain), **row))
+    return result
+
+
+def output(result: list, fmt: str) -> None:
+    if fmt == "json":
+        json.dump(result, sys.stdout, indent=1)
+        print()
+    elif result:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(result[0]))
+        writer.writeheader()
+        writer.writerows(result)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Analyse the sensor history")
+    parser.add_argument("directory", help="history directory")
+    parser.add_argument("command", choices=("columns", "percentiles", "resample", "retrains"))
+    parser.add_argument("column", nargs="?")
+    parser.add_argument("--every", choices=PERIODS, default="hour", help="length of the periods")
+    parser.add_argument("--days", type=float, help="only the last DAYS days")
+    parser.add_argument("-p", "--percentiles", type=float, nargs="+", help="percentiles to compute")
+    parser.add_argument("--window", type=int, default=3, help="periods before and after every retrain")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    args = parser.parse_args(argv)
+
+    if args.command != "columns" and args.column is None:
+        parser.error(f"{args.command} needs a column")
+    try:
+        if args.command == "columns":
+            print("\n".join(listColumns(args.directory)))
+            return 0
+        columns = [args.column] + ([LINK_STATE_COLUMN] if args.command == "retrains" else [])
+        since = time.time() - args.days * 86400 if args.days else None
+        data = loadColumns(args.directory, list(dict.fromkeys(columns)), since)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    commands = {"percentiles": commandPercentiles, "resample": commandResample, "retrains": commandRetrains}
+    output(commands[args.command](data, args), args.format)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
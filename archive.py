@@ -0,0 +1,184 @@
+"""
+Deduplicated, compressed archive of the raw libmapi_dsl_cli dumps.
+
+A dump is only stored when its content changed, ignoring the timestamp header and the monotonic counters.
+Stored dumps are collected into batches which are compressed with zstd (if the zstandard module is
+installed) or zlib. index.tsv maps the time of every stored dump to its batch and position in the
+decompressed batch. The oldest batches are removed when the archive grows beyond its size cap.
+
+Pending dumps are also written when the oldest one reaches the age limit and when the link state changes, so a
+crash loses at most a few minutes and never the dumps from just before an outage.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import time
+import zlib
+
+from sensors import SENSORS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = "index.tsv"
+LINK_STATE = "DSL link state"
+
+# lines starting with one of these change with every dump and are ignored for deduplication
+IGNORE_PREFIXES = tuple(
+    linestart for linestart, sensor in SENSORS.items()
+    if sensor.get("state_class") == "total_increasing" or sensor.get("internal")
+)
+
+
+def _compress(data: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(filename: str, data: bytes) -> bytes:
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("zstandard module is required to read " + filename)
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class DumpArchive:
+    def __init__(self, directory: str, maxbytes: int = 20 * 1024 * 1024, batchsize: int = 32, maxage: float = 300):
+        """
+        :param directory: where batches and index are stored
+        :param maxbytes: size cap for all batches together
+        :param batchsize: number of changed dumps that are compressed together
+        :param maxage: seconds a dump may stay pending
+        """
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.batchsize = batchsize
+        self.maxage = maxage
+        self.pending = []
+        self.lasthash = None
+        self.linkstate = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def _digest(lines: list) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for line in lines[1:]:  # first line is the timestamp header
+            if not line.startswith(IGNORE_PREFIXES):
+                digest.update(line.encode())
+        return digest.digest()
+
+    def add(self, lines: list) -> bool:
+        """
+        Add a dump to the archive if it differs from the last one
+        :param lines: collected lines, starting with the timestamp header
+        :return: True if the dump was stored
+        """
+        now = time.time()
+        linkstate = next((line.strip() for line in lines if line.startswith(LINK_STATE)), self.linkstate)
+        changed = self.linkstate is not None and linkstate != self.linkstate
+        self.linkstate = linkstate
+        digest = self._digest(lines)
+        stored = digest != self.lasthash
+        if stored:
+            self.lasthash = digest
+            self.pending.append((now, digest.hex(), "".join(lines).encode()))
+        if self.pending and (changed or len(self.pending) >= self.batchsize or self.pending[0][0] + self.maxage <= now):
+            self.flush()
+        return stored
+
+    def flush(self) -> None:
+        """
+        Compress all pending dumps into a new batch file
+        :return:
+        """
+        if not self.pending:
+            return
+        batchid = int(self.pending[0][0] * 1000)
+        while any(name.startswith(f"batch-{batchid}.") for name in os.listdir(self.directory)):
+            batchid += 1
+        batchname = f"batch-{batchid}" + (".zst" if zstandard is not None else ".z")
+        index = []
+        offset = 0
+        for timestamp, digest, data in self.pending:
+            index.append(f"{timestamp:.3f}\t{batchname}\t{offset}\t{len(data)}\t{digest}\n")
+            offset += len(data)
+        with open(os.path.join(self.directory, batchname), "wb") as f:
+            f.write(_compress(b"".join(data for _, _, data in self.pending)))
+        with open(os.path.join(self.directory, INDEX_FILE), "a") as f:
+            f.writelines(index)
+        logging.debug(f"Archived {len(self.pending)} dumps in {batchname}")
+        self.pending = []
+        self._prune()
+
+    def _prune(self) -> None:
+        batches = sorted(
+            (name for name in os.listdir(self.directory) if name.startswith("batch-")),
+            key=lambda name: int(name.split("-")[1].split(".")[0]),
+        )
+        sizes = {name: os.path.getsize(os.path.join(self.directory, name)) for name in batches}
+        total = sum(sizes.values())
+        removed = set()
+        while batches and total > self.maxbytes:
+            name = batches.pop(0)
+            total -= sizes[name]
+            os.remove(os.path.join(self.directory, name))
+            removed.add(name)
+        if removed:
+            logging.info(f"Removed {len(removed)} old batches from dump archive")
+            entries = [entry for entry in readIndex(self.directory) if entry[1] not in removed]
+            with open(os.path.join(self.directory, INDEX_FILE), "w") as f:
+                f.writelines(f"{ts:.3f}\t{name}\t{offset}\t{length}\t{digest}\n"
+                             for ts, name, offset, length, digest in entries)
+
+
+def readIndex(directory: str) -> list:
+    """
+    :param directory:
+    :return: list of (timestamp, batchfile, offset, length, digest)
+    """
+    entries = []
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            for line in f:
+                timestamp, name, offset, length, digest = line.rstrip("\n").split("\t")
+                entries.append((float(timestamp), name, int(offset), int(length), digest))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def readDump(directory: str, timestamp: float) -> str:
+    """
+    Returns the dump that was current at the given time
+    :param directory:
+    :param timestamp:
+    :return:
+    """
+    match = None
+    for entry in readIndex(directory):
+        if entry[0] > timestamp:
+            break
+        match = entry
+    if match is None:
+        raise LookupError("No dump archived before " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)))
+    _, name, offset, length, _ = match
+    with open(os.path.join(directory, name), "rb") as f:
+        data = _decompress(name, f.read())
+    return data[offset:offset + length].decode()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <archive directory> [YYYY-MM-DD HH:MM:SS]")
+        sys.exit(1)
+    if len(sys.argv) == 2:
+        for entry in readIndex(sys.argv[1]):
+            print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry[0])), entry[1], entry[4])
+    else:
+        print(readDump(sys.argv[1], time.mktime(time.strptime(" ".join(sys.argv[2:]), "%Y-%m-%d %H:%M:%S"))), end="")
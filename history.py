@@ -0,0 +1,100 @@
+"""
+Columnar history of the numeric sensor values.
+
+Every column is a file of native float64 values (<column>.f64), one value per data request and the same number
+of rows in every file. Missing values are NaN. Appending a row is one small write per column, and readers can
+memory-map the files and get NumPy arrays without parsing anything, see analyze.py.
+"""
+
+import logging
+import os
+import struct
+
+from sensors import SENSORS
+
+SUFFIX = ".f64"
+TIME_COLUMN = "time"
+VALUE = struct.Struct("=d")
+
+
+def _uid(linestart: str, sensor: dict) -> str:
+    return (sensor.get("name") or linestart).replace(" ", "_").lower()
+
+
+# numeric sensors, by the key they have in modemData
+COLUMNS = tuple(_uid(linestart, sensor) for linestart, sensor in SENSORS.items() if sensor.get("type") is not str)
+
+# columns that hold counters which only increase until the modem restarts
+COUNTERS = frozenset(_uid(linestart, sensor) for linestart, sensor in SENSORS.items()
+                     if sensor.get("state_class") == "total_increasing")
+
+
+class HistoryWriter:
+    def __init__(self, directory: str, columns: tuple = COLUMNS, maxrows: int = 180 * 24 * 360):
+        """
+        :param directory: where the column files are stored
+        :param columns: names of the columns besides the time
+        :param maxrows: number of rows to keep, the oldest are removed once there are 10% more
+        """
+        self.directory = directory
+        self.columns = columns
+        self.maxrows = maxrows
+        self.fds = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.rows = self._open()
+
+    def _filename(self, column: str) -> str:
+        return os.path.join(self.directory, column + SUFFIX)
+
+    def _open(self) -> int:
+        """
+        Open all column files and bring them to the same length. The time is written last, so after a crash
+        it is never longer than the other columns.
+        :return: number of rows
+        """
+        timefile = self._filename(TIME_COLUMN)
+        rows = os.path.getsize(timefile) // VALUE.size if os.path.exists(timefile) else 0
+        for column in self.columns + (TIME_COLUMN,):
+            fd = os.open(self._filename(column), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            size = os.fstat(fd).st_size
+            if size > rows * VALUE.size:
+                os.ftruncate(fd, rows * VALUE.size)
+            elif size < rows * VALUE.size:
+                # new column, or one that was cut short
+                os.ftruncate(fd, size - size % VALUE.size)
+                os.write(fd, VALUE.pack(float("nan")) * (rows - size // VALUE.size))
+            self.fds[column] = fd
+        return rows
+
+    def append(self, timestamp: float, values: dict) -> None:
+        """
+        Append one row
+        :param timestamp:
+        :param values: {column: value}, columns that are missing or not numeric are stored as NaN
+        :return:
+        """
+        for column in self.columns:
+            value = values.get(column)
+            os.write(self.fds[column], VALUE.pack(value if isinstance(value, (int, float)) else float("nan")))
+        os.write(self.fds[TIME_COLUMN], VALUE.pack(timestamp))
+        self.rows += 1
+        if self.rows > self.maxrows * 1.1:
+            self._prune()
+
+    def _prune(self) -> None:
+        drop = self.rows - self.maxrows
+        for column, fd in self.fds.items():
+            temporary = self._filename(column) + ".tmp"
+            with open(temporary, "wb") as f:
+                os.lseek(fd, drop * VALUE.size, os.SEEK_SET)
+                f.write(os.read(fd, self.maxrows * VALUE.size))
+            os.replace(temporary, self._filename(column))
+            os.close(fd)
+            self.fds[column] = os.open(self._filename(column), os.O_RDWR | os.O_APPEND)
+        self.rows = self.maxrows
+        logging.debug(f"Removed {drop} rows from the history")
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
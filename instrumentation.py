@@ -0,0 +1,100 @@
+"""
+Low-overhead latency histograms for the stages of the main loop.
+
+Timings are collected in fixed-size histograms with power-of-two buckets from 1µs to ~67s, so recording a
+value is a few integer operations and memory use does not grow. When disabled, start() returns 0 and
+stop() returns right away.
+"""
+
+import logging
+import math
+import threading
+import time
+
+BUCKETS = 27  # 2^0 .. 2^26 µs
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        micros = int(seconds * 1000000)
+        bucket = micros.bit_length()
+        if bucket >= BUCKETS:
+            bucket = BUCKETS - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        """
+        Upper bound of the bucket that contains the given percentile, in seconds
+        :param percent:
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << bucket) / 1000000, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Instrumentation:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.histograms = {}
+        # stages are added by the sink workers while the main loop reads the summary
+        self.lock = threading.Lock()
+        self.since = time.time()
+
+    def start(self) -> float:
+        """
+        Returns the start time for stop(), or 0 if instrumentation is disabled
+        :return:
+        """
+        if self.enabled:
+            return time.perf_counter()
+        return 0.0
+
+    def stop(self, stage: str, started: float) -> None:
+        if started:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.add(seconds)
+
+    def summary(self) -> dict:
+        with self.lock:
+            histograms = list(self.histograms.items())
+        return {stage: histogram.summary() for stage, histogram in histograms}
+
+    def dump(self, name: str = "") -> None:
+        logging.info(f"Timing statistics {name} since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.since))}:")
+        for stage, summary in self.summary().items():
+            logging.info(f"  {stage:<16} n={summary['count']:<8} mean={summary['mean_ms']:.3f}ms "
+                         f"p50<={summary['p50_ms']:.3f}ms p99<={summary['p99_ms']:.3f}ms max={summary['max_ms']:.3f}ms")
@@ -1,11 +1,38 @@
+import faulthandler
 import logging
 import sys
 import signal
 
+import sdnotify
 from modemcontroller import DSLModem
+from multiline import LineController
+
+sdnotify.TIMER.add("imports", sdnotify.TIMER.started)
 
 SERIAL_INTERFACE = "/dev/serial0"
+# add more entries to control several modems from one process, e.g.
+# {"serialport": "/dev/ttyUSB0", "identifier": "dslmodem_backup", "devicename": "DSL-Modem Backup"}
+# PROBES and REBOOT_POLICY below apply to the first line, which owns the relay. The modem of every line has
+# 169.254.0.1, so probes of the other lines are set in their entry with "probes": {...}
+# add "push": True to let a loop on the modem stream compact records instead of polling it, see agent.py
+LINES = [
+    {"serialport": SERIAL_INTERFACE},
+]
 RUNDIR = "/run/dsl-modem/"
+ARCHIVEDIR = "/var/lib/dsl-modem/archive/"
+# per-tone SNR/bit loading captures, needs numpy. Set to None to disable
+TONESDIR = "/var/lib/dsl-modem/tones/"
+# raw serial transcripts saved on errors, read them with transcript.py
+TRANSCRIPTDIR = "/var/lib/dsl-modem/transcripts/"
+# history of the sensor values, analyse it with analyze.py
+HISTORYDIR = "/var/lib/dsl-modem/history/"
+# round trip time and loss are measured to these addresses, e.g. add "Upstream": "9.9.9.9"
+PROBES = {"Modem": "169.254.0.1"}
+# power-cycle the modem when the line degrades, in the quietest hour of the day. Only logs what it would do
+# unless "dryrun" is False. Set to None to disable, see policy.py for the rules, "cooldown" and "maxperday"
+REBOOT_POLICY = {"dryrun": True}
+# collect timing statistics of the main loop, dumped to the log on SIGUSR1
+INSTRUMENTATION = True
 
 logging.basicConfig(
     encoding="utf-8",
@@ -18,10 +45,24 @@ def killhandler(_signal = None, _frame = None):
     sys.exit(0)
 
 
+def dumphandler(_signal = None, _frame = None):
+    ser.dumpInstrumentation()
+
+
+# systemd sends SIGABRT when the watchdog expires, log where every thread is stuck
+faulthandler.enable()
 signal.signal(signal.SIGTERM, killhandler)
+signal.signal(signal.SIGUSR1, dumphandler)
 
 if __name__ == "__main__":
-    ser = DSLModem(SERIAL_INTERFACE, rundir=RUNDIR)
+    if len(LINES) > 1:
+        ser = LineController(LINES, rundir=RUNDIR, archivedir=ARCHIVEDIR, instrument=INSTRUMENTATION,
+                             tonesdir=TONESDIR, transcriptdir=TRANSCRIPTDIR, historydir=HISTORYDIR, probes=PROBES,
+                             rebootpolicy=REBOOT_POLICY)
+    else:
+        ser = DSLModem(**LINES[0], rundir=RUNDIR, archivedir=ARCHIVEDIR, instrument=INSTRUMENTATION,
+                       tonesdir=TONESDIR, transcriptdir=TRANSCRIPTDIR, historydir=HISTORYDIR, probes=PROBES,
+                       rebootpolicy=REBOOT_POLICY)
     try:
         ser.loopForever()
     except KeyboardInterrupt:
@@ -1,13 +1,28 @@
+import json
 import logging
 import re
+import select
 import threading
 import time
+from collections import deque
 import serial
+import agent
 import mqtt
+import sdnotify
 from random import random
-from gpiozero import OutputDevice, Button, LED
-from sensors import SENSORS, LINK_STATES
-from rgb1602 import LCD
+from sensors import SENSORS, LINK_STATES, DERIVED_SENSORS
+from snapshot import SnapshotWriter, SNAPSHOT_FILE
+from archive import DumpArchive
+from instrumentation import Instrumentation
+from tones import ToneCapture
+from trigger import CoalescingTrigger
+from transcript import SerialTranscript
+from history import HistoryWriter
+from timeline import LinkTimeline
+from pipeline import Pipeline, DROP
+from throughput import ThroughputSampler
+from probe import Probe, Prober, probeSensors
+from policy import RebootPolicy
 
 COMMAND_DSL_DATA = b"\nlibmapi_dsl_cli\n"
 COMMAND_ETH_DATA = b"ethtool eth0_1 | grep Link\n"
@@ -17,6 +32,19 @@ COMMAND_SET_ROUTE = b"\nip route add 0.0.0.0/0 via 169.254.0.1\n"
 
 ETH_IF = "enxb827ebc05d0a"
 
+# event-triggered data refreshes, see CoalescingTrigger: leading delay, minimum spacing between refreshes and
+# quiet time before the trailing refresh after a burst of events
+REFRESH_TRIGGERS = {
+    "training status": {"leading": 0, "spacing": 5, "settle": 3},
+    "showtime": {"leading": 2, "spacing": 5, "settle": 3},
+    "libphy": {"leading": 0, "spacing": 5, "settle": 3},
+    "sw version": {"leading": 2, "spacing": 0, "settle": 0},
+}
+
+# data request periods without progress of the main loop before systemd restarts the service. A silent modem is
+# detected after about two periods and then probed every 5 seconds, which counts as progress.
+WATCHDOG_PERIODS = 6
+
 re_sw_version = re.compile(r"^\d{6}\.\d{1,2}\.\d{1,2}\.\d{3}\.\d{1,2}$")
 re_int = re.compile(r"\D*(\d*)")
 re_float = re.compile(r"\D*(\d+\.?\d*)")
@@ -29,20 +57,22 @@ def getValueFromString(line: str, returntype: type):
     :param returntype:
     :return:
     """
+    # only the value after the colon, names like "CV/CRC-8 anomalies" contain digits too
+    value = line.split(":", maxsplit=1)[-1]
     if returntype is int:
-        match = re_int.match(line)
+        match = re_int.match(value)
         if match is not None:
             return int(match[1])
         else:
             return 0
     elif returntype is hex:
-        match = re_hex.match(line)
+        match = re_hex.match(value)
         if match is not None:
             return int(match[1], 16)
         else:
             return 0
     elif returntype is float:
-        match = re_float.match(line)
+        match = re_float.match(value)
         if match is not None:
             return float(match[1])
         else:
@@ -54,13 +84,35 @@ def getValueFromString(line: str, returntype: type):
         raise TypeError("No Type defined")
 
 class DSLModem:
-    def __init__(self, serialport: str, baudrate: int = 115200, timeout: float = 1, rundir: str = None):
+    def __init__(self, serialport: str, baudrate: int = 115200, timeout: float = 1, rundir: str = None,
+                 archivedir: str = None, identifier: str = mqtt.IDENTIFIER, devicename: str = mqtt.DEVICENAME,
+                 ethif: str = ETH_IF, hardware: bool = True, connection: 'mqtt.Client' = None,
+                 instrument: bool = False, tonesdir: str = None, transcriptdir: str = None,
+                 historydir: str = None, push: bool = False, probes: dict = None,
+                 rebootpolicy: dict = None):
+        """
+        :param identifier: MQTT topic prefix and HASS device identifier of this line
+        :param devicename: HASS device name of this line
+        :param ethif: network interface the modem is connected to
+        :param hardware: whether this line owns the buttons, display and LEDs of the board
+        :param connection: shared MQTT connection when several lines are controlled by one process
+        :param instrument: collect timing statistics of the main loop
+        :param tonesdir: where per-tone captures are stored, None disables them
+        :param transcriptdir: where the serial transcript is saved on errors
+        :param historydir: where the history of the sensor values is stored, None disables it
+        :param push: install a loop on the modem that streams compact records instead of polling, see agent.py
+        :param probes: {label: IP address} to measure round trip time and loss to, see probe.py
+        :param rebootpolicy: arguments of the RebootPolicy that power-cycles the modem automatically, see policy.py
+        """
+        started = time.monotonic()
         self.LEDThread = None
+        self.ethif = ethif
         self.ethpacketcounter: int = 0
         self.serialport = serialport
         self.baudrate = baudrate
         self.timeout = timeout
         self.serial = serial.Serial(self.serialport, self.baudrate, timeout=self.timeout)
+        sdnotify.TIMER.add("serial", started)
         self.rundir = rundir
         self.modemData = {}
         self.trainingmode: int = 0
@@ -69,59 +121,198 @@ class DSLModem:
         self.modemAvailable: bool = False
         self.lastAvailabilityCheck: float = 0
         self.showtime: bool = False
-        self.mqtt = mqtt.Client(SENSORS.items())
+        self.probes = probes or {}
+        sensors = dict(DERIVED_SENSORS)
+        for label in self.probes:
+            sensors.update(probeSensors(label))
+        self.mqtt = mqtt.Client(list(SENSORS.items()) + list(sensors.items()), discovery_cache=self.rundir + "discovery.key",
+                                identifier=identifier, devicename=devicename, connection=connection)
         self.nextDataRequest: float = 0
+        self.triggers = {event: CoalescingTrigger(**config) for event, config in REFRESH_TRIGGERS.items()}
         self.DataRequestTimer: float = 10
         self.lastReceived: float = time.time()
         self.lastReceivedTimeout: float = self.DataRequestTimer + timeout * 2
+        if push:
+            # the agent sends a record every period plus the time its commands take
+            self.lastReceivedTimeout = self.DataRequestTimer * 3 + timeout * 2
         self.collectedData = []
         self.collectingData: bool = False
+        self.snapshot = SnapshotWriter(self.rundir + SNAPSHOT_FILE)
+        self.archive = DumpArchive(archivedir) if archivedir else None
+        self.tones = ToneCapture(tonesdir) if tonesdir else None
+        self.history = HistoryWriter(historydir) if historydir else None
+        self.timeline = LinkTimeline()
+        self.policy = RebootPolicy(self.powerCycleModem, statefile=self.rundir + "rebootpolicy.json",
+                                   **rebootpolicy) if rebootpolicy is not None else None
+        self.push = push
+        self.lastRecord: float = 0
+        self.transcript = SerialTranscript(self.rundir + "transcript.ring", freezedir=transcriptdir)
+        self.instr = Instrumentation(instrument)
+        # everything that may block is done by the sinks, so the serial port is read without delays
+        self.pipeline = Pipeline()
+        self.pipeline.add("mqtt", self._publishSensor)
+        self.pipeline.add("files", self._writeStateFile)
+        if self.history:
+            self.pipeline.add("history", self._appendHistory, maxsize=64, policy=DROP)
+        if self.archive:
+            # compresses and writes batches, every dump counts
+            self.pipeline.add("archive", self._archiveDump, maxsize=32, policy=DROP)
+        self.pipeline.add("display", self._refreshDisplay, maxsize=1)
+        if self.tones:
+            # parsing and compressing the tables takes a while on a Pi Zero
+            self.pipeline.add("tones", self._processTones, maxsize=1)
+        self.lastLoop: float = 0
+        self.lastLoopPeriod: float = 0
+        self.commandSent: float = 0
+        self.diagnosticsTimer: float = 60
+        self.nextDiagnostics: float = time.time() + self.diagnosticsTimer
 
-        # initialize Modembutton
         self.modemButtonPressed: bool = False
         self.modemReboot: bool = False
+        self.page = 0
+        # (time, DS SNR margin) of the last hour for the sparkline page
+        self.sparklinePeriod: float = 3600
+        self.snrHistory = deque(maxlen=int(self.sparklinePeriod / self.DataRequestTimer) + 1)
+        # appended to by the main loop, read by the display sink
+        self.snrLock = threading.Lock()
+        self.displayTimer = None
+        self.pageResetTimer = 10
+        self.hardware = hardware
+        self.switch = None
+        self.displaybutton = None
+        self.display = None
+        self.LED = None
+        self.throughput = None
+        self.prober = None
+        self.initThread = None
+        self.firstLine = True
+
+    def start(self) -> None:
+        """
+        Initialize MQTT and the hardware in the background, so reading from the serial port can start right away
+        :return:
+        """
+        self.initThread = threading.Thread(target=self._initBackground, name="InitThread", daemon=True)
+        self.initThread.start()
+
+    def _initBackground(self) -> None:
+        started = time.monotonic()
+        self.mqtt.setup()
+        sdnotify.TIMER.add("mqtt", started)
+        if self.tones and not self.tones.prepare():
+            self.tones = None
+        if self.hardware:
+            self._initHardware()
+        if self.probes:
+            self.prober = Prober([Probe(label, target) for label, target in self.probes.items()])
+            self.prober.start()
+
+    def _initHardware(self) -> None:
+        started = time.monotonic()
+        # initialize Modembutton
         self.switch = ModemButton(27, 21, self)
 
         # initialize Displaybutton
         self.displaybutton = DisplayButton(22, self)
+        sdnotify.TIMER.add("buttons", started)
 
         # initialize display
-        self.page = 0
-        self.display = LCD()
+        started = time.monotonic()
+        from rgb1602 import LCD
+        display = LCD()
+        display.backlight.brightness(50)
+        self.display = display
         self.updateDisplay()
-        self.display.backlight.brightness(50)
-        self.displayTimer = None
-        self.pageResetTimer = 10
+        sdnotify.TIMER.add("display", started)
 
         # initialize LEDs
+        started = time.monotonic()
         self.LED = ETHLEDs()
+        self.throughput = ThroughputSampler(self.ethif)
+        self.LEDThread = LEDThread(self.LED, self.ethif, self.throughput)
+        self.LEDThread.start()
+        sdnotify.TIMER.add("leds", started)
 
     def loopForever(self) -> None:
-        self.LEDThread = LEDThread(self.LED)
-        self.LEDThread.start()
+        self.start()
+        sdnotify.notify("READY=1")
+        sdnotify.WATCHDOG.start(self.DataRequestTimer * WATCHDOG_PERIODS)
         while True:
-            self.loop()
+            self.loop(readable=self.wait())
+
+    def wait(self, timeout: float = 1) -> bool:
+        """
+        Wait for data on the serial port and service the MQTT connection in the meantime
+        :param timeout:
+        :return: True if the serial port is readable
+        """
+        fd = self.serial.fileno() if self.serial.is_open else None
+        mqttread, mqttwrite = self.mqtt.sockets()
+        try:
+            readable, writable, _ = select.select(mqttread + ([fd] if fd is not None else []), mqttwrite, [], timeout)
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            return True
+        self.mqtt.service(readable, writable)
+        return fd is None or fd in readable
 
     def resetSerial(self) -> None:
         if self.serial.is_open:
             self.serial.close()
         self.serial = serial.Serial(self.serialport, self.baudrate, timeout=self.timeout)
 
-    def loop(self) -> None:
+    def send(self, data: bytes) -> None:
+        self.transcript.tx(data)
+        self.serial.write(data)
+
+    def loop(self, readable: bool = True) -> None:
+        """
+        Handle one line from the modem and do the periodic work
+        :param readable: False if the caller knows there is no data waiting on the serial port
+        :return:
+        """
+        if self.instr.enabled:
+            now = time.perf_counter()
+            if self.lastLoop:
+                period = now - self.lastLoop
+                self.instr.record("loop period", period)
+                if self.lastLoopPeriod:
+                    self.instr.record("loop jitter", abs(period - self.lastLoopPeriod))
+                self.lastLoopPeriod = period
+            self.lastLoop = now
+
+        # the loop only counts as progressing if it talks to the modem
+        progress = False
         if not self.modemAvailable:
             if self.lastAvailabilityCheck + 5 < time.time():
                 logging.debug("Send Availability Check...")
                 self.lastAvailabilityCheck = time.time()
                 self.resetSerial()
-                self.serial.write(b"\n")  # Send newline to activate prompt
+                self.send(b"\n")  # Send newline to activate prompt
+                progress = True
 
         line = ""
         try:
-            line = self.serial.readline().strip().decode()
+            if readable:
+                started = self.instr.start()
+                raw = self.serial.readline()
+                self.instr.stop("serial read", started)
+                if raw:
+                    progress = True
+                    self.transcript.rx(raw)
+                    line = raw.strip().decode()
         except UnicodeDecodeError:
-            pass
+            logging.debug("Could not decode line from modem")
+            self.transcript.freeze("decode")
         except Exception as e:
             logging.error(e)
+            self.transcript.freeze("serial")
+
+        if line and self.firstLine:
+            self.firstLine = False
+            sdnotify.TIMER.add("first line", sdnotify.TIMER.started)
+            logging.info("Startup: " + sdnotify.TIMER.report())
+            sdnotify.notify("STATUS=Startup: " + sdnotify.TIMER.report())
 
         if line.startswith("root@SpeedportW925V"):
             self.modemReboot = False
@@ -129,10 +320,15 @@ class DSLModem:
             if not self.modemAvailable:
                 logging.info("Serial connection to modem established")
                 self.modemAvailable = True
-                self.serial.write(COMMAND_SET_ROUTE)
+                self.send(COMMAND_SET_ROUTE)
                 self.mqtt.connect()
+                if self.push:
+                    self.installAgent()
             if line.startswith("root@SpeedportW925V:/# libmapi_dsl_cli"):
                 logging.debug("Collecting DSL data")
+                if self.commandSent:
+                    self.instr.record("command lag", time.time() - self.commandSent)
+                    self.commandSent = 0
                 self.collectingData = True
                 self.collectedData = [time.strftime("%Y-%m-%d %H:%M:%S\n\n")]
                 line = ""
@@ -143,102 +339,223 @@ class DSLModem:
                     self.writeCollectedData()
                     if self.mqtt.swversion == "":
                         logging.info("Requesting Software Version from modem")
-                        self.serial.write(COMMAND_GET_SW_VERSION)
-                line = line[len("root@SpeedportW925V:/#"):-1].strip()
+                        self.send(COMMAND_GET_SW_VERSION)
+                rest = line[len("root@SpeedportW925V:/#"):].strip()
+                # records of the agent aren't synchronised with the prompt and may follow it on the same line
+                if rest.startswith((agent.RECORD, agent.KEEPALIVE)):
+                    line = rest
+                else:
+                    line = line[len("root@SpeedportW925V:/#"):-1].strip()
 
         if line.startswith(">"):
             # we're stuck in a prompt we dont want to be in. Try to recover...
             logging.error("Got '>' prompt, trying to recover automatically")
-            self.serial.write(b"\x03")  # CTRL+C
-            self.serial.write(b"\x04")  # CTRL+D
+            self.transcript.freeze("prompt")
+            self.send(b"\x03")  # CTRL+C
+            self.send(b"\x04")  # CTRL+D
             time.sleep(0.1)
-            self.serial.write(b"\n")  # newline to activate shell again in case we closed it with CTRL-D
+            self.send(b"\n")  # newline to activate shell again in case we closed it with CTRL-D
 
         if line != "":
-            self.parseLine(line)
+            started = self.instr.start()
+            if line.startswith((agent.RECORD, agent.KEEPALIVE)):
+                self.parseRecord(line)
+            else:
+                self.parseLine(line)
+            self.instr.stop("parseLine", started)
             self.trainingmode = self.modemData.get("dsl_link_state")
             if self.trainingmode is None or not self.modemAvailable:
                 self.trainingmode = 0
+            self.snapshot.setState(self.modemAvailable, self.trainingmode)
+            if "dsl_link_state" in self.modemData and self.timeline.observe(self.trainingmode):
+                self.publishTimeline()
 
         if self.modemAvailable or self.modemReboot:
-            if self.nextDataRequest <= time.time():
+            now = time.time()
+            if self.nextDataRequest <= now or (not self.modemReboot and
+                                               any(trigger.due(now) for trigger in self.triggers.values())):
                 self.requestModemData()
+            elif self.tones and self.trainingmode in (0x800, 0x801) and self.tones.due():
+                logging.debug("Requesting per-tone data...")
+                self.send(self.tones.command())
 
             # timeout - Modem is offline
             if self.lastReceived + self.lastReceivedTimeout < time.time():
                 logging.error("Lost serial connection to modem!")
+                self.transcript.freeze("lost")
                 self.modemAvailable = False
                 self.modemReboot = False
-                self.mqtt.disconnect()
                 self.trainingmode = 0
+                self.timeline.lost()
+                self.publishTimeline()
+                self.mqtt.disconnect()
                 self.modemData = {}
+                self.snapshot.clear()
+                self.pipeline.emit(None, None, "archive")
                 self.updateDisplay()
 
+        started = self.instr.start()
         self.updateLEDs()
+        self.instr.stop("leds", started)
+
+        if progress:
+            sdnotify.WATCHDOG.progress()
 
     def parseLine(self, line: str) -> None:
         # logging.debug(line)
+        if self.tones and self.tones.feed(line):
+            if self.tones.finished():
+                self.pipeline.emit("tones", self.tones.take(), "tones")
+            return
+
         if self.collectingData:
             self.collectedData.append(line + "\n")
 
         try:
             for linestart, sensor in SENSORS.items():
                 if line.startswith(linestart):
-                    if not sensor.get("name"):
-                        sensor["name"] = linestart
-                    uid = sensor.get("name").replace(" ", "_").lower()
-                    self.modemData[uid] = getValueFromString(line, sensor.get("type"))
-                    if sensor.get("convert"):
-                        sensorvalue = sensor.get("convert").get(self.modemData.get(uid))
-                        if sensorvalue is None:
-                            sensorvalue = "unknown"
-                        self.mqtt.publish(uid + "/raw", str(self.modemData.get(uid)))
-                    else:
-                        sensorvalue = str(self.modemData.get(uid))
-                    self.mqtt.publish(uid, sensorvalue, retain=True)
-                    with open(self.rundir + uid + ".txt", "w") as f:
-                        f.write(sensorvalue + "\n")
-                    logging.debug(f'{sensor.get("name")}: {sensorvalue}')
+                    self.updateSensor(linestart, sensor, line)
                     return
 
             if line.startswith("xDSL training status changed"):
-                self.nextDataRequest = time.time()
+                self.triggers["training status"].fire()
 
             elif line.startswith("xDSL Enter SHOWTIME"):
                 logging.info("Showtime!")
                 self.showtime = True
-                self.nextDataRequest = time.time() + 2
+                self.triggers["showtime"].fire()
 
             elif line.startswith("xDSL Leave SHOWTIME"):
                 logging.info("No Showtime.")
                 self.showtime = False
-                self.nextDataRequest = time.time() + 2
+                self.triggers["showtime"].fire()
 
             elif line.find("libphy: 0:02") > 0:
-                self.nextDataRequest = time.time()
+                self.triggers["libphy"].fire()
 
             elif re_sw_version.match(line):
                 logging.info("Got Software Version: " + line)
                 self.mqtt.swversion = line
                 self.mqtt.hass_discovery()
-                self.nextDataRequest = time.time() + 2
+                self.triggers["sw version"].fire()
 
         except TypeError as e:
             logging.error(e)
         except Exception as e:
             logging.error(e)
 
+    def updateSensor(self, linestart: str, sensor: dict, line: str) -> None:
+        name = sensor.get("name") or linestart
+        uid = name.replace(" ", "_").lower()
+        self.modemData[uid] = getValueFromString(line, sensor.get("type"))
+        self.snapshot.store(uid, self.modemData.get(uid))
+        raw = None
+        if sensor.get("convert"):
+            sensorvalue = sensor.get("convert").get(self.modemData.get(uid))
+            if sensorvalue is None:
+                sensorvalue = "unknown"
+            raw = str(self.modemData.get(uid))
+        else:
+            sensorvalue = str(self.modemData.get(uid))
+        self.pipeline.emit(uid, (sensorvalue, raw, sensor.get("qos", mqtt.QOS), sensor.get("message_expiry")), "mqtt")
+        self.pipeline.emit(uid, sensorvalue, "files")
+        logging.debug(f'{name}: {sensorvalue}')
+
+    def _publishSensor(self, uid: str, value: tuple) -> None:
+        sensorvalue, raw, qos, expiry = value
+        started = self.instr.start()
+        if raw is not None:
+            self.mqtt.publish(uid + "/raw", raw)
+        self.mqtt.publish(uid, sensorvalue, retain=True, qos=qos, expiry=expiry)
+        self.instr.stop("mqtt publish", started)
+
+    def _writeStateFile(self, uid: str, sensorvalue: str) -> None:
+        started = self.instr.start()
+        with open(self.rundir + uid + ".txt", "w") as f:
+            f.write(sensorvalue + "\n")
+        self.instr.stop("file write", started)
+
+    def _appendHistory(self, _key, row: tuple) -> None:
+        self.history.append(*row)
+
+    def _archiveDump(self, _key, lines: list) -> None:
+        """
+        :param _key:
+        :param lines: collected lines of a dump, None to write the pending dumps
+        :return:
+        """
+        if lines is None:
+            self.archive.flush()
+        else:
+            self.archive.add(lines)
+
+    def installAgent(self) -> None:
+        logging.info("Installing the streaming agent on the modem")
+        self.send(agent.install(self.DataRequestTimer, [COMMAND_ETH_DATA.decode().strip(),
+                                                        COMMAND_DSL_DATA.decode().strip()]))
+        self.lastRecord = time.time()
+        if self.mqtt.swversion == "":
+            self.send(COMMAND_GET_SW_VERSION)
+
+    def parseRecord(self, line: str) -> None:
+        """
+        Handle a record of the streaming agent like a complete libmapi_dsl_cli dump
+        :param line:
+        :return:
+        """
+        try:
+            uptime, values = agent.parseRecord(line)
+        except ValueError as e:
+            logging.warning(e)
+            self.transcript.freeze("record")
+            return
+        self.lastReceived = self.lastRecord = time.time()
+        # polling is only the fallback if the agent stops sending
+        self.nextDataRequest = time.time() + self.DataRequestTimer * 3
+        self.updateSensor(agent.UPTIME, SENSORS[agent.UPTIME], f"{agent.UPTIME}: {uptime}")
+        if values is None:
+            # unchanged values, the history, throughput, probes and reboot policy still need their periodic update
+            self.collectedData[:1] = [time.strftime("%Y-%m-%d %H:%M:%S\n\n")]
+        else:
+            if self.commandSent:
+                self.instr.record("command lag", time.time() - self.commandSent)
+                self.commandSent = 0
+            self.collectedData = [time.strftime("%Y-%m-%d %H:%M:%S\n\n")]
+            for linestart, value in values.items():
+                self.collectedData.append(f"{linestart}: {value}\n")
+                self.updateSensor(linestart, SENSORS[linestart], f"{linestart}: {value}")
+        self.writeCollectedData()
+        self.publishDiagnostics()
+
     def close(self) -> None:
         logging.info("Closing connections...")
+        if self.initThread:
+            self.initThread.join(5)
         if self.displayTimer:
             self.displayTimer.cancel()
-        self.LEDThread.stop()
-        self.LEDThread.join()
-        self.display.clear()
-        self.display.backlight.RGB(0, 0, 0)
+        if self.LEDThread:
+            self.LEDThread.stop()
+            self.LEDThread.join()
+        if self.throughput:
+            self.throughput.close()
+        if self.prober:
+            self.prober.stop()
+        self.pipeline.close()
+        if self.display:
+            self.display.clear()
+            self.display.backlight.RGB(0, 0, 0)
         self.mqtt.disconnect()
+        if self.push and self.serial.is_open:
+            self.send(agent.stop())
         self.serial.close()
-        self.LED.close()
+        self.snapshot.close()
+        self.transcript.close()
+        if self.archive:
+            self.archive.flush()
+        if self.history:
+            self.history.close()
+        if self.LED:
+            self.LED.close()
         logging.info("Connections closed.")
 
     def requestModemData(self) -> None:
@@ -247,16 +564,107 @@ class DSLModem:
             self.mqtt.connect()
 
         self.nextDataRequest = time.time() + self.DataRequestTimer
-        self.serial.write(COMMAND_UPTIME)
-        self.serial.write(COMMAND_ETH_DATA)
-        self.serial.write(COMMAND_DSL_DATA)
+        for trigger in self.triggers.values():
+            trigger.ran(time.time())
+        if self.push:
+            if self.lastRecord + self.DataRequestTimer * 3 < time.time():
+                logging.warning("No records from the streaming agent, reinstalling it")
+                self.installAgent()
+            else:
+                self.send(agent.once())
+        else:
+            self.send(COMMAND_UPTIME)
+            self.send(COMMAND_ETH_DATA)
+            self.send(COMMAND_DSL_DATA)
+        self.commandSent = time.time()
+        self.publishDiagnostics()
+
+    def publishDiagnostics(self) -> None:
+        if self.instr.enabled and self.nextDiagnostics <= time.time():
+            self.nextDiagnostics = time.time() + self.diagnosticsTimer
+            self.mqtt.publish("diagnostics/timing", json.dumps(self.instr.summary()))
+            self.mqtt.publish("diagnostics/mqtt", json.dumps(self.mqtt.stats()))
+            self.mqtt.publish("diagnostics/pipeline", json.dumps(self.pipeline.stats()))
+
+    def _processTones(self, _key, lines: dict) -> None:
+        started = time.perf_counter()
+        summaries = self.tones.process(lines)
+        logging.info(f"Processed per-tone data in {(time.perf_counter() - started) * 1000:.0f}ms")
+        for direction, summary in summaries.items():
+            if summary.get("bands"):
+                self.mqtt.publish("tones/" + direction, json.dumps(summary), retain=True)
+
+    def publishTimeline(self) -> None:
+        for uid, value in self.timeline.summary().items():
+            if value is not None:
+                self.mqtt.publish(uid, str(value), retain=True)
+        self.mqtt.publish("link_timeline", json.dumps(self.timeline.recent()), retain=True)
+
+    def publishThroughput(self) -> None:
+        if self.throughput is None:
+            return
+        summary = self.throughput.summary(self.modemData.get("ds_current_data_rate"),
+                                          self.modemData.get("us_current_data_rate"))
+        for uid, value in summary.items():
+            if value is not None:
+                self.mqtt.publish(uid, str(value), retain=True)
+
+    def applyPolicy(self) -> None:
+        if self.policy is None:
+            return
+        packets = self.throughput.packets if self.throughput and self.throughput.last is not None else None
+        if self.policy.update(self.modemData, packets):
+            self.mqtt.publish("reboot_policy", json.dumps(self.policy.state()), retain=True)
+
+    def powerCycleModem(self, reason: str) -> None:
+        """
+        Power-cycle the modem with the relay, in the background
+        :param reason:
+        :return:
+        """
+        if self.switch is None:
+            logging.error(f"Cannot power-cycle the modem ({reason}), this line has no relay")
+            return
+        threading.Thread(target=self.switch.powerCycle, name="PowerCycle", daemon=True).start()
+
+    def dumpInstrumentation(self) -> None:
+        if self.instr.enabled:
+            self.instr.dump(self.mqtt.identifier)
+            logging.info(f"  MQTT: {self.mqtt.stats()}")
+            for name, stats in self.pipeline.stats().items():
+                logging.info(f"  sink {name:<11} lag p99<={stats['p99_ms']:.3f}ms max={stats['max_ms']:.3f}ms "
+                             f"pending={stats['pending']} dropped={stats['dropped']} coalesced={stats['coalesced']}")
+        else:
+            logging.info("Instrumentation is disabled")
 
     def writeCollectedData(self) -> None:
         with open(self.rundir + "collectedData.txt", "w") as f:
             f.writelines(self.collectedData)
+        self.pipeline.emit(None, list(self.collectedData), "archive")
+        self.pipeline.emit(None, (time.time(), dict(self.modemData)), "history")
+        self.publishTimeline()
+        self.publishThroughput()
+        if self.prober:
+            for uid, value in self.prober.summary().items():
+                if value is not None:
+                    self.mqtt.publish(uid, str(value), retain=True)
+        self.applyPolicy()
+        if self.modemData.get("downstream_snr_margin") is not None:
+            with self.snrLock:
+                self.snrHistory.append((time.time(), self.modemData.get("downstream_snr_margin")))
         self.updateDisplay()
 
     def updateDisplay(self) -> None:
+        if self.display is None:
+            return
+        self.pipeline.emit("display", None, "display")
+
+    def _refreshDisplay(self, _key, _value) -> None:
+        started = self.instr.start()
+        self._updateDisplay()
+        self.instr.stop("display", started)
+
+    def _updateDisplay(self) -> None:
         if self.modemButtonPressed:
             self.display.backlight.RGB(255, 0, 255)
         elif self.modemReboot:
@@ -284,9 +692,25 @@ class DSLModem:
                 elif self.page == 2:
                     self.display.print("Error-Counter:", 0, 0)
                     self.display.print(f"{self._count_errors()}", 1, 0)
+                elif self.page == 3:
+                    lines = []
+                    for direction, current, attainable in (
+                            ("U", "us_current_data_rate", "upstream_attainable_data_rate"),
+                            ("D", "ds_current_data_rate", "downstream_attainable_data_rate")):
+                        fraction = (self.modemData.get(current) or 0) / (self.modemData.get(attainable) or 1)
+                        lines.append(f"{direction}{min(fraction, 9.99):>4.0%}" + self.display.bar(fraction, 11))
+                    # uploading glyphs moves the address counter into CGRAM, so always set the cursor
+                    self.display.setCursor(0, 0)
+                    self.display.print(lines[0])
+                    self.display.print(lines[1], 1, 0)
+                elif self.page == 4:
+                    sparkline = self._sparkline()
+                    self.display.setCursor(0, 0)
+                    self.display.print(f"DS SNR {self.modemData.get('downstream_snr_margin', 0):>5.1f} dB")
+                    self.display.print(sparkline, 1, 0)
                 else:
                     self.page = 0
-                    self.updateDisplay()
+                    self._updateDisplay()
             else:
                 self.display.print("DSL:", 0, 0)
                 try:
@@ -308,6 +732,8 @@ class DSLModem:
         self.updateDisplay()
 
     def updateLEDs(self) -> None:
+        if self.LED is None:
+            return
         # update DSL connection LEDs
         if self.trainingmode in (0x800, 0x801):  # showtime
             self.LED.off(3, 1)
@@ -325,6 +751,24 @@ class DSLModem:
         else:
             self.LED.off(2, 2)
 
+    def _sparkline(self) -> str:
+        columns = 16
+        now = time.time()
+        sums = [0.0] * columns
+        counts = [0] * columns
+        with self.snrLock:
+            history = list(self.snrHistory)
+        for timestamp, value in history:
+            column = int((timestamp - now + self.sparklinePeriod) / self.sparklinePeriod * columns)
+            if 0 <= column < columns:
+                sums[column] += value
+                counts[column] += 1
+        values = [total / count if count else None for total, count in zip(sums, counts)]
+        known = [value for value in values if value is not None]
+        if not known:
+            return ""
+        return self.display.sparkline(values, min(known), max(known))
+
     def _count_errors(self) -> int:
         errors = 0
         for key, data in self.modemData.items():
@@ -334,6 +778,7 @@ class DSLModem:
 
 class ModemButton:
     def __init__(self, inputpin, outputpin, modem: 'DSLModem'):
+        from gpiozero import OutputDevice, Button
         self.output = OutputDevice(pin=outputpin, initial_value=True, active_high=True)
         self.button = Button(pin=inputpin, pull_up=True, bounce_time=None, hold_time=3)
         self.modem = modem
@@ -359,6 +804,11 @@ class ModemButton:
 
     def _restart(self) -> None:
         logging.info("Modem Button Held")
+        self.powerCycle()
+
+    def powerCycle(self) -> None:
+        if self.modem.policy:
+            self.modem.policy.powerCycled()
         self.modem.nextDataRequest = time.time() + 30
         self.modem.modemButtonPressed = False
         self.modem.modemReboot = True
@@ -369,6 +819,7 @@ class ModemButton:
 
 class DisplayButton:
     def __init__(self, inputpin: int, modem: 'DSLModem'):
+        from gpiozero import Button
         self.button = Button(pin=inputpin, pull_up=True, bounce_time=0.1, hold_time=3)
         self.modem = modem
         self.pressed = False
@@ -385,10 +836,12 @@ class DisplayButton:
         self.pressed = False
 
 class LEDThread(threading.Thread):
-    def __init__(self, led: 'ETHLEDs'):
+    def __init__(self, led: 'ETHLEDs', ethif: str = ETH_IF, throughput: ThroughputSampler = None):
         threading.Thread.__init__(self)
         self.name = "LEDThread"
         self.LED = led
+        self.ethif = ethif
+        self.throughput = throughput or ThroughputSampler(ethif)
         self.ethpacketcounter = 0
         self.running = True
 
@@ -397,18 +850,16 @@ class LEDThread(threading.Thread):
         while self.running:
             # update ETH connection LEDs
             # check if eth0 is connected
-            with open("/sys/class/net/"+ETH_IF+"/carrier") as f:
+            with open("/sys/class/net/"+self.ethif+"/carrier") as f:
                 carrier = f.readline().strip()
             if carrier:
                 self.LED.on(1, 2)
             else:
                 self.LED.off(1, 2)
 
-            # read eth0 packet count for actvity led
-            with open("/sys/class/net/"+ETH_IF+"/statistics/tx_packets") as f:
-                packets = int(f.readline().strip())
-            with open("/sys/class/net/"+ETH_IF+"/statistics/rx_packets") as f:
-                packets += int(f.readline().strip())
+            # sample the eth0 counters, the packet count is used for the actvity led
+            self.throughput.sample()
+            packets = self.throughput.packets
             if packets != self.ethpacketcounter and not self.LED.value(1, 1):
                 self.ethpacketcounter = packets
                 self.LED.on(1, 1)
@@ -431,6 +882,7 @@ class ETHLEDs:
         """
         Controls the ETH LEDs on the board
         """
+        from gpiozero import LED
         self.eth1_1 = LED(18)
         self.eth1_2 = LED(17)
         self.eth2_1 = LED(8)
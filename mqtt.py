@@ -1,7 +1,10 @@
+import errno
+import hashlib
 import logging
+import socket
+import threading
 import time
 
-import paho.mqtt.client as mqtt
 import json
 
 SERVER = "10.101.100.21"
@@ -9,80 +12,386 @@ PORT = 1883
 USER = ""
 PASSWORD = ""
 MQTT_DISCOVERY_BASETOPIC = "homeassistant/"
+HASS_STATUS_TOPIC = MQTT_DISCOVERY_BASETOPIC + "status"
 IDENTIFIER = "dslmodem_private"
+DEVICENAME = "DSL-Modem Privat"
+
+# MQTT 5 adds topic aliases for the QoS 0 state topics, message expiry and a will delay
+PROTOCOL_V5 = False
+QOS = 0  # default QoS, can be overridden per sensor with "qos"
+LWT_QOS = 1
+WILL_DELAY = 10  # seconds the broker waits before publishing the LWT, so short reconnects don't flap (MQTT 5)
+
+CONNECT_TIMEOUT = 10
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
 
 
 class Client:
-    def __init__(self, sensors: dict, send_again_timeout: float = 300):
+    def __init__(self, sensors: dict, send_again_timeout: float = 300, discovery_cache: str = None,
+                 identifier: str = IDENTIFIER, devicename: str = DEVICENAME, connection: 'Client' = None):
+        """
+        :param identifier: topic prefix and HASS device identifier
+        :param devicename: HASS device name
+        :param connection: Client whose broker connection is shared, used when one process controls several
+                           lines. The line then only publishes its own LWT and the connection owns the will.
+        """
         self.sensors = sensors
         self.sendAgain = send_again_timeout
-        self.mqtt = mqtt.Client()
-        self.mqtt.on_connect = self.on_connect
-        self.mqtt.on_disconnect = self.on_disconnect
+        self.identifier = identifier
+        self.devicename = devicename
+        self.connection = connection
+        self.lines = []
+        self.active = False
+        # connection handling, see sockets() and service()
+        self.wanted = False
+        self.pending = None
+        self.pendingSince: float = 0
+        self.nextAttempt: float = 0
+        self.backoff: float = BACKOFF_MIN
+        self._mqtt = None
+        self._setupLock = threading.Lock()
+        # values are published from the sink threads too, see pipeline.py
+        self._sendLock = threading.Lock()
+        self._wakeup = None
+        if self.connection is not None:
+            self.connection.lines.append(self)
         self.connected = False
-        self.basetopic = IDENTIFIER + "/"
+        self.basetopic = self.identifier + "/"
         self.swversion = ""
         self.history = {}
 
+        # MQTT 5 topic aliases of this connection {topic: alias}, reset on every connect
+        self.aliases = {}
+        self.aliasMaximum = 0
+        # estimated bytes of all PUBLISH packets and bytes saved by topic aliases
+        self.bytesSent = 0
+        self.bytesSaved = 0
+
+        # precomputed discovery payloads {topic: bytes}, rebuilt when swversion or the sensors change
+        self.discoveryPayloads = {}
+        self.discoveryKey = None
+        self.discoveryPending = False
+        # key of the discovery messages that were last published (survives restarts if a file is given)
+        self.discoveryCache = discovery_cache
+        self.publishedKey = None
+        if self.discoveryCache:
+            try:
+                with open(self.discoveryCache) as f:
+                    self.publishedKey = f.read().strip()
+            except FileNotFoundError:
+                pass
+
+    @property
+    def mqtt(self):
+        """
+        The paho client, created on first use so importing paho doesn't delay startup
+        """
+        if self.connection is not None:
+            return self.connection.mqtt
+        if self._mqtt is None:
+            self.setup()
+        return self._mqtt
+
+    def setup(self) -> None:
+        if self.connection is not None:
+            self.connection.setup()
+            return
+        with self._setupLock:
+            if self._mqtt is not None:
+                return
+            import paho.mqtt.client as paho
+            if PROTOCOL_V5:
+                from paho.mqtt.properties import Properties
+                from paho.mqtt.packettypes import PacketTypes
+                self._properties = Properties
+                self._packettypes = PacketTypes
+                client = paho.Client(protocol=paho.MQTTv5)
+            else:
+                client = paho.Client()
+            client.on_connect = self.on_connect
+            client.on_disconnect = self.on_disconnect
+            client.on_message = self.on_message
+            # only the main loop writes to the socket, publishing from other threads just wakes it up
+            self._wakeup = socket.socketpair()
+            for sock in self._wakeup:
+                sock.setblocking(False)
+            client.on_socket_register_write = self._wake
+            self._mqtt = client
+
     def connect(self):
+        """
+        Start connecting to the broker without blocking, the connection is made by service()
+        :return:
+        """
+        if self.connection is not None:
+            self.active = True
+            if self.connection.connected:
+                self.on_connect()
+            else:
+                self.connection.connect()
+            return
+        self.wanted = True
+        if self.pending is None and self.mqtt.socket() is None and self.nextAttempt <= time.time():
+            self._startConnect()
+
+    def _startConnect(self) -> None:
+        properties = None
+        if PROTOCOL_V5:
+            properties = self._properties(self._packettypes.WILLMESSAGE)
+            properties.WillDelayInterval = WILL_DELAY
+        # the will is sent with the CONNECT packet, so it has to be set before connecting
+        self.mqtt.will_set(self.basetopic + "LWT", "offline", qos=LWT_QOS, retain=True, properties=properties)
+        self.mqtt.connect_async(SERVER, PORT)
+
+        # probe the broker with a non-blocking TCP connect first, paho's own connect only runs once the broker
+        # answered, so it doesn't block for long. SERVER should be an IP address, resolving a hostname would block.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        result = sock.connect_ex((SERVER, PORT))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._connectFailed(errno.errorcode.get(result, str(result)))
+            return
+        logging.debug("Connecting to MQTT-Server...")
+        self.pending = sock
+        self.pendingSince = time.time()
+
+    def _connectFailed(self, reason: str) -> None:
+        logging.warning(f"Could not connect to MQTT-Server ({reason}), retrying in {self.backoff:.0f}s")
+        self.nextAttempt = time.time() + self.backoff
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+    def _wake(self, *_args) -> None:
         try:
-            self.mqtt.connect(SERVER, PORT)
-        except TimeoutError:
+            self._wakeup[1].send(b"\0")
+        except BlockingIOError:
             pass
-        else:
-            self.mqtt.will_set(self.basetopic + "LWT", "offline", retain=True)
-            self.mqtt.loop_start()
+
+    def sockets(self) -> tuple:
+        """
+        Sockets to wait for with select(), pass the results to service()
+        :return: (read, write)
+        """
+        if self.connection is not None:
+            return self.connection.sockets()
+        if self.pending is not None:
+            return [], [self.pending]
+        sock = self.mqtt.socket() if self._mqtt else None
+        if sock is None:
+            return [], []
+        return [sock, self._wakeup[0]], [sock] if self.mqtt.want_write() else []
+
+    def service(self, readable: list = (), writable: list = ()) -> None:
+        """
+        Do the network work of the connection, to be called after every select()
+        :param readable:
+        :param writable:
+        :return:
+        """
+        if self.connection is not None:
+            self.connection.service(readable, writable)
+            return
+        if self.pending is not None:
+            if self.pending in writable:
+                sock = self.pending
+                self.pending = None
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result:
+                    sock.close()
+                    self._connectFailed(errno.errorcode.get(result, str(result)))
+                    return
+                sock.close()
+                try:
+                    self.mqtt.reconnect()
+                except OSError as e:
+                    self._connectFailed(str(e))
+            elif self.pendingSince + CONNECT_TIMEOUT < time.time():
+                self.pending.close()
+                self.pending = None
+                self._connectFailed("timeout")
+            return
+        if self._mqtt is None:
+            return
+        if self._wakeup[0] in readable:
+            try:
+                self._wakeup[0].recv(4096)
+            except BlockingIOError:
+                pass
+        sock = self.mqtt.socket()
+        if sock is None:
+            if self.wanted and self.nextAttempt <= time.time():
+                self._startConnect()
+            return
+        if sock in readable:
+            self.mqtt.loop_read()
+        if sock in writable:
+            self.mqtt.loop_write()
+        self.mqtt.loop_misc()
 
     def disconnect(self):
-        self.publish("LWT", "offline", retain=True)
-        self.mqtt.loop_stop()
+        self.publish("LWT", "offline", retain=True, qos=LWT_QOS)
+        if self.connection is not None:
+            self.active = False
+            self.connected = False
+            return
+        self.wanted = False
+        if self.pending is not None:
+            self.pending.close()
+            self.pending = None
         self.mqtt.disconnect()
+        if self.mqtt.socket() is not None:
+            self.mqtt.loop_write()
 
     def on_connect(self, *_args, **_kwargs):
+        if self.connection is not None and not self.active:
+            return
         self.connected = True
-        logging.info("Connected to MQTT-Server")
-        self.publish("LWT", "online", retain=True)
-        # self.hass_discovery()
+        logging.info(f"Connected to MQTT-Server ({self.identifier})")
+        if self.connection is None:
+            self.backoff = BACKOFF_MIN
+            properties = _args[4] if len(_args) > 4 else None
+            with self._sendLock:
+                # aliases are only valid for one network connection
+                self.aliases = {}
+                self.aliasMaximum = getattr(properties, "TopicAliasMaximum", 0) if PROTOCOL_V5 else 0
+        self.publish("LWT", "online", retain=True, qos=LWT_QOS)
+        if self.connection is None:
+            self.mqtt.subscribe(HASS_STATUS_TOPIC)
+        if self.discoveryPending:
+            self.hass_discovery()
+        for line in self.lines:
+            line.on_connect()
 
     def on_disconnect(self, *_args, **_kwargs):
         self.connected = False
-        logging.info("MQTT disconnected")
+        logging.info(f"MQTT disconnected ({self.identifier})")
+        if self.connection is None and self.wanted:
+            self._connectFailed("connection lost")
+        for line in self.lines:
+            line.on_disconnect()
+
+    def on_message(self, _client, _userdata, message) -> None:
+        # Home Assistant birth message, ignore retained ones so reconnects don't trigger a resend
+        if message.topic == HASS_STATUS_TOPIC and message.payload == b"online" and not message.retain:
+            logging.info("Home Assistant is online")
+            if self.discoveryKey is not None:
+                self.hass_discovery(force=True)
+        for line in self.lines:
+            line.on_message(_client, _userdata, message)
 
     def is_connected(self) -> bool:
         return self.mqtt.is_connected()
 
-    def publish(self, topic: str, message: str, retain: bool = False, fulltopic: bool = False):
+    def publish(self, topic: str, message: str, retain: bool = False, fulltopic: bool = False, qos: int = QOS,
+                expiry: int = None):
+        """
+        :param topic:
+        :param message:
+        :param retain:
+        :param fulltopic: topic does not start with the basetopic, it won't get a topic alias either
+        :param qos:
+        :param expiry: message expiry interval in seconds (MQTT 5 only)
+        :return:
+        """
         if self.connected:
             if not fulltopic:
                 topic = self.basetopic + topic
             if not topic in self.history.keys():
                 self.history[topic] = {"message": "", "timestamp": 0}
             if message != self.history.get(topic).get("message") or self.history.get(topic).get("timestamp") + self.sendAgain < time.time():
-                self.mqtt.publish(topic, message, retain=retain)
+                (self.connection or self)._send(topic, message, qos, retain, expiry, alias=not fulltopic)
                 self.history[topic] = {"message": message, "timestamp": time.time()}
 
+    def _send(self, topic: str, payload, qos: int = QOS, retain: bool = False, expiry: int = None,
+              alias: bool = False) -> None:
+        properties = None
+        propertybytes = 0
+        with self._sendLock:
+            if PROTOCOL_V5:
+                properties = self._properties(self._packettypes.PUBLISH)
+                propertybytes = 1
+                if expiry:
+                    properties.MessageExpiryInterval = expiry
+                    propertybytes += 5
+                # paho resends unacknowledged QoS 1/2 messages after a reconnect as they were, but the aliases
+                # only live as long as one network connection, so these always carry the full topic
+                if alias and not qos:
+                    number = self.aliases.get(topic)
+                    if number is None and len(self.aliases) < self.aliasMaximum:
+                        # first use sends the topic together with the alias
+                        number = self.aliases[topic] = len(self.aliases) + 1
+                        properties.TopicAlias = number
+                        propertybytes += 3
+                    elif number is not None:
+                        properties.TopicAlias = number
+                        propertybytes += 3
+                        self.bytesSaved += len(topic)
+                        topic = ""
+            # the alias has to be on the wire in the same order it was assigned
+            self.mqtt.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            # fixed header, topic length, topic, packet id, properties and payload
+            self.bytesSent += 2 + 2 + len(topic) + (2 if qos else 0) + propertybytes + len(payload)
+
+    def stats(self) -> dict:
+        root = self.connection or self
+        return {
+            "protocol": 5 if PROTOCOL_V5 else 4,
+            "topic_aliases": len(root.aliases),
+            "bytes_sent": root.bytesSent,
+            "bytes_saved": root.bytesSaved,
+        }
+
+    def _schemaKey(self) -> str:
+        schema = json.dumps([(linestart, sensor) for linestart, sensor in self.sensors], sort_keys=True, default=str)
+        return hashlib.sha1((self.swversion + schema).encode()).hexdigest()
+
+    def hass_discovery(self, force: bool = False) -> None:
+        """
+        Publish the HASS discovery messages if swversion or the sensors changed since they were last sent
+        :param force: publish even if nothing changed, e.g. after Home Assistant restarted
+        :return:
+        """
+        key = self._schemaKey()
+        if key != self.discoveryKey:
+            self.discoveryPayloads = {}
+            for linestart, sensor in self.sensors:
+                if not sensor.get("internal"):
+                    topic, payload = self.hass_discovery_message(**dict(sensor, name=sensor.get("name") or linestart))
+                    self.discoveryPayloads[topic] = payload
+            self.discoveryKey = key
+
+        if not force and key == self.publishedKey:
+            logging.debug("HASS Discovery Messages are up to date")
+            return
+        if not self.connected:
+            self.discoveryPending = True
+            return
 
-    def hass_discovery(self):
         logging.info("Sending HASS Discovery Messages...")
-        for linestart, sensor in self.sensors:
-            if not sensor.get("internal"):
-                if not sensor.get("name"):
-                    sensor["name"] = linestart
-                if type(sensor.get("convert")) is dict:
-                    sensor["options"] = list(sensor["convert"].values())
-                    sensor["device_class"] = "enum"
-                self.hass_discovery_message(**sensor)
-
-    def hass_discovery_message(self, name: str, icon: str = None, **kwargs) -> None:
+        for topic, payload in self.discoveryPayloads.items():
+            (self.connection or self)._send(topic, payload, retain=True)
+        self.discoveryPending = False
+        self.publishedKey = key
+        if self.discoveryCache:
+            with open(self.discoveryCache, "w") as f:
+                f.write(key + "\n")
+
+    def hass_discovery_message(self, name: str, icon: str = None, **kwargs) -> tuple:
         kwargs.pop("type", None)
-        kwargs.pop("convert", None)
-        logging.debug("Sending HASS Discovery Message for " + name)
+        kwargs.pop("internal", None)
+        kwargs.pop("message_expiry", None)
+        convert = kwargs.pop("convert", None)
+        if type(convert) is dict:
+            kwargs["options"] = list(convert.values())
+            kwargs["device_class"] = "enum"
+        logging.debug("Building HASS Discovery Message for " + name)
 
         uid = name.replace(" ", "_").lower()
 
         device = {
-                "name": "DSL-Modem Privat",
-                "identifiers": [IDENTIFIER],
+                "name": self.devicename,
+                "identifiers": [self.identifier],
                 "manufacturer": "Deutsche Telekom",
                 "model": "Speedport W925V",
                 "sw_version": self.swversion,
@@ -90,18 +399,21 @@ class Client:
 
         payload = {
             "name": name,
-            "unique_id": IDENTIFIER.lower() + "_" + uid,
+            "unique_id": self.identifier.lower() + "_" + uid,
             "device": device,
             "availability_topic": self.basetopic + "LWT",
             "state_topic": self.basetopic + uid,
             "icon": "mdi:"+icon,
         }
+        if self.connection is not None:
+            # the line is only available if both the shared connection and the line itself are online
+            del payload["availability_topic"]
+            payload["availability"] = [{"topic": self.connection.basetopic + "LWT"}, {"topic": self.basetopic + "LWT"}]
+            payload["availability_mode"] = "all"
 
         for arg, value in kwargs.items():
             if value:
                 payload[arg] = value
 
-        self.publish(MQTT_DISCOVERY_BASETOPIC + "sensor/" + IDENTIFIER + "/" + uid + "/config",
-                     json.dumps(payload), retain=True, fulltopic=True)
-
-
+        return (MQTT_DISCOVERY_BASETOPIC + "sensor/" + self.identifier + "/" + uid + "/config",
+                json.dumps(payload).encode())
@@ -0,0 +1,93 @@
+"""
+Controls several modems from one process.
+
+All lines are driven by a single select() loop over their serial ports and share one MQTT connection. Every
+line gets its own topic prefix and HASS device, and its own subdirectory in rundir and the archive. Only the
+first line owns the buttons, display, LEDs and the relay of the board, so the global probes and reboot policy
+apply to it. Other lines can set their own "probes" in their entry.
+"""
+
+import logging
+import os
+import select
+
+import mqtt
+import sdnotify
+from modemcontroller import DSLModem, WATCHDOG_PERIODS
+
+IDENTIFIER = "dslmodem"
+
+# serial read timeout per line, short so a prompt without newline on one line doesn't hold up the others
+SERIAL_TIMEOUT = 0.1
+
+
+class LineController:
+    def __init__(self, lines: list, rundir: str, archivedir: str = None, instrument: bool = False,
+                 tonesdir: str = None, transcriptdir: str = None, historydir: str = None, probes: dict = None,
+                 rebootpolicy: dict = None):
+        """
+        :param lines: list of dicts with the DSLModem arguments of every line (serialport, identifier, ...)
+        :param rundir:
+        :param archivedir:
+        :param instrument: collect timing statistics of the main loop
+        :param tonesdir:
+        :param transcriptdir:
+        :param historydir:
+        :param probes: probes of the first line, unless its entry sets "probes"
+        :param rebootpolicy: reboot policy of the first line, unless its entry sets "rebootpolicy"
+        """
+        self.mqtt = mqtt.Client((), identifier=IDENTIFIER)
+        self.modems = []
+        for number, line in enumerate(lines):
+            identifier = line.get("identifier", f"{IDENTIFIER}_{number}")
+            linerundir = os.path.join(rundir, identifier, "")
+            os.makedirs(linerundir, exist_ok=True)
+            line = dict(line, identifier=identifier)
+            if number == 0:
+                line.setdefault("probes", probes)
+                line.setdefault("rebootpolicy", rebootpolicy)
+            elif line.get("rebootpolicy") is not None:
+                logging.warning(f"Line {identifier} has no relay to power-cycle the modem, its reboot policy only logs")
+            self.modems.append(DSLModem(
+                **line,
+                timeout=SERIAL_TIMEOUT,
+                rundir=linerundir,
+                archivedir=os.path.join(archivedir, identifier, "") if archivedir else None,
+                hardware=(number == 0),
+                connection=self.mqtt,
+                instrument=instrument,
+                tonesdir=os.path.join(tonesdir, identifier, "") if tonesdir else None,
+                transcriptdir=os.path.join(transcriptdir, identifier, "") if transcriptdir else None,
+                historydir=os.path.join(historydir, identifier, "") if historydir else None,
+            ))
+        logging.info(f"Controlling {len(self.modems)} lines")
+
+    def loopForever(self) -> None:
+        for modem in self.modems:
+            modem.start()
+        sdnotify.notify("READY=1")
+        sdnotify.WATCHDOG.start(max(modem.DataRequestTimer for modem in self.modems) * WATCHDOG_PERIODS)
+        while True:
+            self.loop()
+
+    def loop(self) -> None:
+        # the serial objects are replaced by resetSerial(), so look the file descriptors up every time
+        fds = [modem.serial.fileno() if modem.serial.is_open else None for modem in self.modems]
+        mqttread, mqttwrite = self.mqtt.sockets()
+        try:
+            readable, writable, _ = select.select([fd for fd in fds if fd is not None] + mqttread, mqttwrite, [], 1)
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            readable, writable = [], []
+        self.mqtt.service(readable, writable)
+        for fd, modem in zip(fds, self.modems):
+            modem.loop(readable=fd in readable)
+
+    def dumpInstrumentation(self) -> None:
+        for modem in self.modems:
+            modem.dumpInstrumentation()
+
+    def close(self) -> None:
+        for modem in self.modems:
+            modem.close()
+        self.mqtt.disconnect()
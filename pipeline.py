@@ -0,0 +1,135 @@
+"""
+Fan-out of parsed values to slow consumers.
+
+The main loop emits events and returns right away. Every sink (MQTT, state files, history, display) has its own
+worker thread and a bounded queue, so a slow broker or a stalled filesystem delays only that sink and never the
+reading of the serial port. When a queue is full, new events are dropped. With the coalesce policy a pending
+event is replaced by a newer one with the same key, so only the latest value of every sensor is delivered.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from instrumentation import Histogram
+
+COALESCE = "coalesce"
+DROP = "drop"
+
+
+class Sink:
+    def __init__(self, name: str, handler, maxsize: int = 256, policy: str = COALESCE):
+        """
+        :param name:
+        :param handler: called with (key, value) for every event, in the worker thread
+        :param maxsize: number of pending events
+        :param policy: COALESCE to replace pending events with the same key, DROP to keep every event
+        """
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.pending = OrderedDict() if policy == COALESCE else deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.lag = Histogram()
+        self.emitted = 0
+        self.handled = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._work, name="sink " + name, daemon=True)
+        self.thread.start()
+
+    def put(self, key, value) -> bool:
+        """
+        Queue an event
+        :param key:
+        :param value:
+        :return: False if the event was dropped
+        """
+        with self.condition:
+            self.emitted += 1
+            if self.policy == COALESCE and key in self.pending:
+                self.pending[key] = (value, time.monotonic())
+                self.coalesced += 1
+                return True
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            if self.policy == COALESCE:
+                self.pending[key] = (value, time.monotonic())
+            else:
+                self.pending.append((key, value, time.monotonic()))
+            self.condition.notify()
+        return True
+
+    def _next(self) -> tuple:
+        if self.policy == COALESCE:
+            key, (value, emitted) = self.pending.popitem(last=False)
+            return key, value, emitted
+        return self.pending.popleft()
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                key, value, emitted = self._next()
+            self.lag.add(time.monotonic() - emitted)
+            try:
+                self.handler(key, value)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Sink {self.name} failed: {e}")
+            self.handled += 1
+
+    def stats(self) -> dict:
+        with self.condition:
+            return dict(self.lag.summary(), pending=len(self.pending), emitted=self.emitted, handled=self.handled,
+                        dropped=self.dropped, coalesced=self.coalesced, errors=self.errors)
+
+    def close(self, timeout: float = 2) -> None:
+        """
+        Deliver the pending events and stop the worker
+        :param timeout:
+        :return:
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logging.warning(f"Sink {self.name} did not finish, {len(self.pending)} events lost")
+
+
+class Pipeline:
+    def __init__(self):
+        self.sinks = {}
+
+    def add(self, name: str, handler, maxsize: int = 256, policy: str = COALESCE) -> Sink:
+        self.sinks[name] = Sink(name, handler, maxsize, policy)
+        return self.sinks[name]
+
+    def emit(self, key, value, *sinks: str) -> None:
+        """
+        Pass an event to the given sinks
+        :param key: events with the same key are coalesced
+        :param value:
+        :param sinks: names of the sinks, the event is ignored by sinks that don't exist
+        :return:
+        """
+        for name in sinks:
+            sink = self.sinks.get(name)
+            if sink is not None:
+                sink.put(key, value)
+
+    def stats(self) -> dict:
+        return {name: sink.stats() for name, sink in self.sinks.items()}
+
+    def close(self, timeout: float = 2) -> None:
+        for sink in self.sinks.values():
+            sink.close(timeout)
@@ -0,0 +1,278 @@
+"""
+Automatic, traffic-aware reboots of the modem.
+
+Rules are evaluated on the parsed line stats after every data request. A rule has to be violated for its whole
+duration before it counts, e.g. "DS rate below 70 % of the attainable rate for an hour" or "more than 100 CRC
+errors per minute for 10 minutes". A reboot is then scheduled for the quietest hour of the day, learned from
+the ETH packet counters, and done only if a rule is still violated at that time. Cooldown and a daily limit,
+which also count power cycles with the modem button, keep a bad line from being rebooted over and over. In
+dry-run mode the policy only logs what it would do. Those decisions are subject to the same limits, but are kept
+apart and don't count once dry run is turned off.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from throughput import counterDelta
+
+# uids as in modemData
+REBOOT_RULES = [
+    {"name": "low sync rate", "type": "ratio", "value": "ds_current_data_rate",
+     "reference": "downstream_attainable_data_rate", "below": 0.7, "for": 3600},
+    {"name": "CRC errors", "type": "rate", "value": "near-end_xdsl_cv-crc-8_anomalies",
+     "above": 100, "per": 60, "for": 600},
+]
+# used until a full day of traffic was seen
+DEFAULT_HOUR = 4
+SHOWTIME = (0x0800, 0x0801)
+
+
+class Rule:
+    def __init__(self, name: str, duration: float = 0):
+        """
+        :param name:
+        :param duration: seconds the condition has to hold before the rule is violated
+        """
+        self.name = name
+        self.duration = duration
+        self.since: float = 0
+        self.active = False
+
+    def condition(self, data: dict, now: float):
+        """
+        Overridden by the rule types
+        :param data: modemData
+        :param now:
+        :return: True or False, None if there is not enough data to decide
+        """
+        return None
+
+    def update(self, data: dict, now: float) -> bool:
+        """
+        Evaluate the rule
+        :param data:
+        :param now:
+        :return: True if the condition held for the whole duration
+        """
+        condition = self.condition(data, now)
+        if condition is None:
+            return self.violated(now)
+        self.active = condition
+        if not condition:
+            self.since = 0
+        elif not self.since:
+            self.since = now
+        return self.violated(now)
+
+    def violated(self, now: float) -> bool:
+        return self.active and self.since and now - self.since >= self.duration
+
+    def reset(self) -> None:
+        self.since = 0
+        self.active = False
+
+
+class RatioRule(Rule):
+    def __init__(self, name: str, value: str, reference: str, below: float, duration: float = 0):
+        Rule.__init__(self, name, duration)
+        self.value = value
+        self.reference = reference
+        self.below = below
+
+    def condition(self, data: dict, now: float):
+        value, reference = data.get(self.value), data.get(self.reference)
+        if data.get("dsl_link_state") not in SHOWTIME or not value or not reference:
+            return None
+        return value < reference * self.below
+
+
+class RateRule(Rule):
+    def __init__(self, name: str, value: str, above: float, per: float = 60, duration: float = 0):
+        Rule.__init__(self, name, duration)
+        self.value = value
+        self.above = above
+        self.per = per
+        self.last = None
+
+    def condition(self, data: dict, now: float):
+        value = data.get(self.value)
+        if value is None:
+            return None
+        last, self.last = self.last, (now, value)
+        # a counter that went down was reset by a modem restart
+        if last is None or value < last[1] or now <= last[0]:
+            return None
+        return (value - last[1]) / (now - last[0]) * self.per > self.above
+
+    def reset(self) -> None:
+        Rule.reset(self)
+        self.last = None
+
+
+def makeRule(config: dict) -> Rule:
+    if config["type"] == "ratio":
+        return RatioRule(config["name"], config["value"], config["reference"], config["below"], config.get("for", 0))
+    if config["type"] == "rate":
+        return RateRule(config["name"], config["value"], config["above"], config.get("per", 60), config.get("for", 0))
+    raise ValueError(f"Unknown rule type {config['type']}")
+
+
+class TrafficProfile:
+    def __init__(self, smoothing: float = 0.3):
+        """
+        Packets per hour of the day, averaged over the days
+        :param smoothing: weight of the latest day
+        """
+        self.smoothing = smoothing
+        self.hours = [None] * 24
+        self.lastPackets = None
+        self.hour = None
+        self.hourPackets = 0
+        # the first hour is only partly seen
+        self.complete = False
+
+    def add(self, packets: int, now: float) -> None:
+        hour = time.localtime(now).tm_hour
+        if self.lastPackets is not None:
+            self.hourPackets += counterDelta(self.lastPackets, packets)
+        self.lastPackets = packets
+        if hour != self.hour:
+            if self.hour is not None and self.complete:
+                old = self.hours[self.hour]
+                self.hours[self.hour] = self.hourPackets if old is None else old + self.smoothing * (self.hourPackets - old)
+            self.complete = self.hour is not None
+            self.hour = hour
+            self.hourPackets = 0
+
+    def quietestHour(self) -> int:
+        if None in self.hours:
+            return DEFAULT_HOUR
+        return self.hours.index(min(self.hours))
+
+    def nextWindow(self, now: float) -> float:
+        """
+        Start of the next quietest hour, or now if it is the current hour
+        :param now:
+        :return:
+        """
+        local = time.localtime(now)
+        hour = self.quietestHour()
+        if local.tm_hour == hour:
+            return now
+        start = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, hour, 0, 0, 0, 0, -1))
+        if start < now:
+            start = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, hour, 0, 0, 0, 0, -1))
+        return start
+
+
+class RebootPolicy:
+    def __init__(self, action, rules: list = REBOOT_RULES, dryrun: bool = True, cooldown: float = 6 * 3600,
+                 maxperday: int = 2, statefile: str = None):
+        """
+        :param action: called with the reason to power-cycle the modem
+        :param rules: rule configurations, see REBOOT_RULES
+        :param dryrun: only log what would be done
+        :param cooldown: minimum seconds between two reboots
+        :param maxperday: maximum number of reboots in 24 hours
+        :param statefile: where the reboot times are kept across restarts of the service
+        """
+        self.action = action
+        self.rules = [makeRule(config) for config in rules]
+        self.dryrun = dryrun
+        self.cooldown = cooldown
+        self.maxperday = maxperday
+        self.statefile = statefile
+        self.profile = TrafficProfile()
+        self.scheduled: float = 0
+        self.reason = ""
+        # times of the real power cycles, also appended to by the button thread
+        self.lock = threading.Lock()
+        self.reboots = []
+        # decisions in dry run, only in memory
+        self.simulated = []
+        if statefile and os.path.exists(statefile):
+            try:
+                with open(statefile) as f:
+                    self.reboots = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read reboot policy state: {e}")
+
+    def allowed(self, now: float) -> bool:
+        with self.lock:
+            self.reboots = [reboot for reboot in self.reboots if reboot > now - 86400]
+            self.simulated = [reboot for reboot in self.simulated if reboot > now - 86400]
+            reboots = sorted(self.reboots + self.simulated) if self.dryrun else self.reboots
+            if reboots and reboots[-1] + self.cooldown > now:
+                return False
+            return len(reboots) < self.maxperday
+
+    def powerCycled(self, now: float = None) -> None:
+        """
+        Record a power cycle of the modem, by the policy or by hand
+        :param now:
+        :return:
+        """
+        with self.lock:
+            self.reboots.append(time.time() if now is None else now)
+            reboots = list(self.reboots)
+        if self.statefile:
+            with open(self.statefile, "w") as f:
+                json.dump(reboots, f)
+
+    def update(self, data: dict, packets: int = None, now: float = None) -> bool:
+        """
+        Evaluate the rules and reboot if one is violated and the quiet window has come
+        :param data: modemData
+        :param packets: ETH packet counter, None if not available
+        :param now:
+        :return: True if the state of the policy changed
+        """
+        if now is None:
+            now = time.time()
+        if packets is not None:
+            self.profile.add(packets, now)
+        violated = [rule.name for rule in self.rules if rule.update(data, now)]
+
+        if not self.scheduled:
+            if not violated or not self.allowed(now):
+                return False
+            self.scheduled = self.profile.nextWindow(now)
+            self.reason = ", ".join(violated)
+            logging.warning(f"Reboot policy: {self.reason}, modem reboot scheduled for "
+                            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(self.scheduled))}")
+            return True
+
+        if now < self.scheduled:
+            return False
+        self.scheduled = 0
+        if not violated:
+            logging.info(f"Reboot policy: {self.reason} recovered, reboot cancelled")
+            return True
+        if not self.allowed(now):
+            # the modem was power-cycled with the button in the meantime
+            logging.info("Reboot policy: cooldown after a recent power cycle, reboot cancelled")
+            return True
+        self.reason = ", ".join(violated)
+        if self.dryrun:
+            logging.warning(f"Reboot policy (dry run): would power-cycle the modem now because of {self.reason}")
+            with self.lock:
+                self.simulated.append(now)
+        else:
+            logging.warning(f"Reboot policy: power-cycling the modem because of {self.reason}")
+            # recorded by the power cycle itself
+            self.action(self.reason)
+        for rule in self.rules:
+            rule.reset()
+        return True
+
+    def state(self) -> dict:
+        return {
+            "dry_run": self.dryrun,
+            "scheduled": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.scheduled)) if self.scheduled else None,
+            "reason": self.reason if self.scheduled else None,
+            "reboots_24h": len([reboot for reboot in self.reboots if reboot > time.time() - 86400]),
+            "violated": [rule.name for rule in self.rules if rule.active],
+        }
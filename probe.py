@@ -0,0 +1,403 @@
+"""
+Round trip time and loss to the modem and optionally further upstream.
+
+Probes are sent with unprivileged ICMP echo sockets (needs net.ipv4.ping_group_range to include the group of
+the service). Without them UDP is used instead: the target answers either with the echoed datagram or with an
+ICMP port unreachable, which a connected UDP socket reports as ECONNREFUSED. Both count as a reply.
+
+All probes run in one thread, a token bucket limits the total probe rate. RTTs go into log-linear histograms,
+so memory use does not grow and percentiles are within 12.5 %. The mean RTT and the loss are per summary, P99 and
+maximum over a rolling window of several minutes, P99 only once there are enough samples for it to mean something.
+To try it against a local stand-in responder:
+
+    python3 probe.py --respond 127.0.0.1 33434
+"""
+
+import errno
+import logging
+import math
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+ICMP = "icmp"
+UDP = "udp"
+UDP_PORT = 33434  # traceroute port, usually closed, so the target answers with port unreachable
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+# sequence number, send time
+PAYLOAD = struct.Struct("!Hd")
+# linear sub-buckets per power of two of the RTT histograms
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+# seconds of summaries that P99 and maximum are taken over
+WINDOW = 300
+MIN_SAMPLES = 100
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def probeSensors(label: str) -> dict:
+    """
+    HASS sensors of a probe, to be added to the sensors of the MQTT client
+    :param label: e.g. "Modem", becomes part of the sensor names
+    :return:
+    """
+    sensors = {}
+    for suffix, icon in (("RTT", "timer-outline"), ("RTT P99", "timer-alert-outline"), ("RTT Max", "timer-alert")):
+        sensors[f"{label} {suffix}"] = {
+            "icon": icon,
+            "entity_category": "diagnostic",
+            "device_class": "duration",
+            "state_class": "measurement",
+            "unit_of_measurement": "ms",
+            "type": float,
+        }
+    sensors[f"{label} Loss"] = {
+        "icon": "lan-disconnect",
+        "entity_category": "diagnostic",
+        "state_class": "measurement",
+        "unit_of_measurement": "%",
+        "type": float,
+    }
+    return sensors
+
+
+class RttHistogram:
+    def __init__(self):
+        """
+        Log-linear histogram of microseconds: SUB_BUCKETS linear buckets per power of two
+        """
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _bucket(micros: int) -> int:
+        if micros < SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - SUB_BITS - 1
+        return ((shift + 1) << SUB_BITS) + (micros >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def _upper(bucket: int) -> int:
+        """
+        Smallest value above the bucket, in microseconds
+        """
+        if bucket < SUB_BUCKETS:
+            return bucket + 1
+        shift = (bucket >> SUB_BITS) - 1
+        return ((bucket & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift
+
+    def add(self, seconds: float) -> None:
+        bucket = self._bucket(int(seconds * 1000000))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'RttHistogram') -> None:
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Upper bound of the bucket that contains the given percentile, in seconds
+        :param percent:
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self._upper(bucket) / 1000000, self.max)
+        return self.max
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Token bucket
+        :param rate: tokens per second
+        :param burst: maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.last = time.monotonic()
+
+    def allow(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self) -> float:
+        """
+        Seconds until the next token is available
+        :return:
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Probe:
+    def __init__(self, label: str, target: str, method: str = ICMP, port: int = UDP_PORT, interval: float = 1,
+                 timeout: float = 2):
+        """
+        :param label: name of the probe, e.g. "Modem"
+        :param target: IP address
+        :param method: ICMP or UDP, ICMP falls back to UDP if ping sockets are not allowed
+        :param port: UDP port
+        :param interval: seconds between two probes
+        :param timeout: seconds after which a probe counts as lost
+        """
+        self.label = label
+        self.uid = label.replace(" ", "_").lower()
+        self.target = target
+        self.port = port
+        self.interval = interval
+        self.timeout = timeout
+        self.method = method
+        self.openFailed = False
+        # None while the socket can't be opened, e.g. the interface is still down at boot
+        self.sock = self._open()
+        self.sequence = 0
+        # sequence: send time, only the probes of the last timeout seconds
+        self.outstanding = {}
+        self.nextProbe: float = 0
+        self.histogram = RttHistogram()
+        # (time, histogram) of the last summaries
+        self.window = deque()
+        self.sent = 0
+        self.received = 0
+
+    def _open(self):
+        if self.method == ICMP:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            except OSError as e:
+                logging.warning(f"ICMP sockets are not available ({e}), probing {self.target} with UDP")
+                self.method = UDP
+            else:
+                sock.setblocking(False)
+                return sock
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect((self.target, self.port))
+        except OSError as e:
+            # retried with every probe, only the first failure is worth a warning
+            (logging.debug if self.openFailed else logging.warning)(f"Cannot probe {self.target} yet: {e}")
+            self.openFailed = True
+            sock.close()
+            return None
+        self.openFailed = False
+        return sock
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, now: float) -> None:
+        self.sequence = (self.sequence + 1) & 0xffff
+        payload = PAYLOAD.pack(self.sequence, now)
+        if self.sock is None:
+            self.sock = self._open()
+        try:
+            if self.sock is None:
+                raise OSError("no socket")
+            if self.method == ICMP:
+                header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, self.sequence)
+                checksum = _checksum(header + payload)
+                packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, 0, self.sequence) + payload
+                self.sock.sendto(packet, (self.target, 0))
+            else:
+                self.sock.send(payload)
+        except OSError as e:
+            # e.g. no route while the modem is down, counts as lost right away
+            logging.debug(f"Probe to {self.target} failed: {e}")
+        else:
+            self.outstanding[self.sequence] = now
+        self.sent += 1
+        self.nextProbe = now + self.interval
+
+    def receive(self, now: float) -> None:
+        while True:
+            try:
+                data = self.sock.recv(512)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                # port unreachable answers a UDP probe, but doesn't tell which one: take the oldest
+                if self.outstanding:
+                    self._reply(min(self.outstanding, key=self.outstanding.get), now)
+                continue
+            except OSError as e:
+                if e.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH):
+                    continue
+                logging.warning(f"Receiving probes from {self.target} failed: {e}")
+                return
+            if self.method == ICMP:
+                if len(data) < 8 + PAYLOAD.size or data[0] != ICMP_ECHO_REPLY:
+                    continue
+                data = data[8:]
+            if len(data) >= PAYLOAD.size:
+                sequence, _ = PAYLOAD.unpack_from(data)
+                self._reply(sequence, now)
+
+    def _reply(self, sequence: int, now: float) -> None:
+        sent = self.outstanding.pop(sequence, None)
+        if sent is None:
+            return  # late or duplicate
+        self.received += 1
+        self.histogram.add(now - sent)
+
+    def expire(self, now: float) -> None:
+        for sequence, sent in list(self.outstanding.items()):
+            if sent + self.timeout < now:
+                del self.outstanding[sequence]
+
+    def summary(self) -> dict:
+        """
+        Statistics by uid, mean RTT and loss since the last summary, P99 and maximum over the last WINDOW seconds
+        :return:
+        """
+        histogram, sent, received = self.histogram, self.sent - len(self.outstanding), self.received
+        self.histogram = RttHistogram()
+        self.sent = len(self.outstanding)
+        self.received = 0
+        now = time.monotonic()
+        self.window.append((now, histogram))
+        while self.window[0][0] < now - WINDOW:
+            self.window.popleft()
+        window = RttHistogram()
+        for _, part in self.window:
+            window.merge(part)
+        summary = {
+            f"{self.uid}_rtt": round(histogram.total / histogram.count * 1000, 2) if histogram.count else None,
+            f"{self.uid}_rtt_p99": round(window.percentile(99) * 1000, 2) if window.count >= MIN_SAMPLES else None,
+            f"{self.uid}_rtt_max": round(window.max * 1000, 2) if window.count else None,
+            f"{self.uid}_loss": round((1 - received / sent) * 100, 1) if sent > 0 else None,
+        }
+        return summary
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+
+
+class Prober(threading.Thread):
+    def __init__(self, probes: list, rate: float = 10):
+        """
+        Runs the probes
+        :param probes:
+        :param rate: maximum number of probes per second, all probes together
+        """
+        threading.Thread.__init__(self)
+        self.name = "Prober"
+        self.daemon = True
+        self.probes = probes
+        self.limiter = RateLimiter(rate, burst=len(probes))
+        self.lock = threading.Lock()
+        self.running = True
+
+    def run(self) -> None:
+        while self.running:
+            try:
+                self._probe()
+            except Exception as e:
+                logging.error(f"Probing failed: {e}")
+                time.sleep(1)
+
+    def _probe(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            for probe in self.probes:
+                if probe.nextProbe <= now:
+                    if self.limiter.allow(now):
+                        probe.send(now)
+                    else:
+                        # without a token the probe would be due again right away and the thread would spin
+                        probe.nextProbe = now + self.limiter.delay()
+                probe.expire(now)
+        wait = min(max(0.0, min(probe.nextProbe for probe in self.probes) - time.monotonic()), 0.5)
+        probes = [probe for probe in self.probes if probe.sock is not None]
+        if not probes:
+            time.sleep(wait)
+            return
+        readable, _, _ = select.select(probes, [], [], wait)
+        now = time.monotonic()
+        with self.lock:
+            for probe in readable:
+                probe.receive(now)
+
+    def summary(self) -> dict:
+        with self.lock:
+            summary = {}
+            for probe in self.probes:
+                summary.update(probe.summary())
+            return summary
+
+    def stop(self) -> None:
+        self.running = False
+        self.join(1)
+        for probe in self.probes:
+            probe.close()
+
+
+def respond(host: str, port: int, count: int = None) -> None:
+    """
+    Stand-in for the modem that echoes UDP probes
+    :param host:
+    :param port:
+    :param count: number of probes to answer, None for no limit
+    :return:
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, port))
+        while count is None or count > 0:
+            data, address = sock.recvfrom(512)
+            sock.sendto(data, address)
+            if count is not None:
+                count -= 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    if len(sys.argv) == 4 and sys.argv[1] == "--respond":
+        # probe a local responder in the same process
+        threading.Thread(target=respond, args=(sys.argv[2], int(sys.argv[3])), daemon=True).start()
+        probes = [Probe("Responder", sys.argv[2], method=UDP, port=int(sys.argv[3]), interval=0.2)]
+    elif len(sys.argv) == 2:
+        probes = [Probe("Target", sys.argv[1])]
+    else:
+        print(f"Usage: {sys.argv[0]} <target> | --respond <address> <port>")
+        sys.exit(1)
+    prober = Prober(probes)
+    prober.start()
+    try:
+        while True:
+            time.sleep(5)
+            print(prober.summary())
+    except KeyboardInterrupt:
+        prober.stop()
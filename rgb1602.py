@@ -59,6 +59,9 @@ LCD_1LINE = 0x00
 LCD_5x10DOTS = 0x04
 LCD_5x8DOTS = 0x00
 
+# full block in the character ROM, used so the graphs need fewer custom glyphs
+LCD_FULLBLOCK = chr(0xff)
+
 lcd_charmap = {
     ord(u'ä'): chr(0xe1),
     ord(u'Ä'): chr(0xe1),
@@ -96,6 +99,11 @@ class LCD:
         self._numcols = cols
         self._currline = 0
         
+        # contents of the 8 CGRAM slots and when they were last used, so glyphs are only uploaded when needed
+        self._glyphs = [None] * 8
+        self._glyphUsed = [0] * 8
+        self._glyphClock = 0
+
         self._bus = smbus.SMBus(i2cbus)
         self._showfunction = LCD_4BITMODE | LCD_1LINE | LCD_5x8DOTS
 
@@ -109,7 +117,7 @@ class LCD:
         # second try
         self.LCDCommand(LCD_FUNCTIONSET | self._showfunction)
         # delayMicroseconds(150);
-        time.sleep(0.005)
+        time.sleep(0.00015)
         # third go
         self.LCDCommand(LCD_FUNCTIONSET | self._showfunction)
         # finally, set # lines, font size, etc.
@@ -219,6 +227,59 @@ class LCD:
 
         for i in range(0, 8):
             self._bus.write_i2c_block_data(LCD_ADDRESS, 0x40, [charmap[i]])
+        self._glyphs[location] = tuple(charmap)
+
+    def glyph(self, charmap: list) -> str:
+        """
+        Returns the character for a custom glyph, uploads it to the least recently used CGRAM slot if it is not
+        loaded yet. A screen can use up to 8 different glyphs. The cursor has to be set after an upload.
+        :param charmap: 8 rows of 5 bits
+        :return:
+        """
+        charmap = tuple(charmap)
+        self._glyphClock += 1
+        if charmap in self._glyphs:
+            location = self._glyphs.index(charmap)
+        else:
+            location = self._glyphUsed.index(min(self._glyphUsed))
+            logging.debug(f"Uploading glyph to CGRAM slot {location}")
+            self.customSymbol(location, list(charmap))
+        self._glyphUsed[location] = self._glyphClock
+        return chr(location)
+
+    def bar(self, fraction: float, width: int) -> str:
+        """
+        Horizontal bar graph with a resolution of 5 columns per character
+        :param fraction: 0.0 - 1.0
+        :param width: in characters
+        :return:
+        """
+        columns = round(max(0.0, min(1.0, fraction)) * width * 5)
+        text = LCD_FULLBLOCK * (columns // 5)
+        if columns % 5:
+            row = ((1 << (columns % 5)) - 1) << (5 - columns % 5)
+            text += self.glyph([row] * 8)
+        return text.ljust(width)
+
+    def sparkline(self, values: list, low: float, high: float) -> str:
+        """
+        One character with 8 levels per value, None leaves the character empty
+        :param values:
+        :param low: value shown as the lowest level
+        :param high: value shown as a full block
+        :return:
+        """
+        text = ""
+        for value in values:
+            if value is None:
+                text += " "
+                continue
+            level = 8 if high <= low else 1 + round(max(0.0, min(1.0, (value - low) / (high - low))) * 7)
+            if level == 8:
+                text += LCD_FULLBLOCK
+            else:
+                text += self.glyph([0x00] * (8 - level) + [0x1f] * level)
+        return text
 
     def blink_on(self) -> None:
         self.blink()
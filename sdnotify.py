@@ -0,0 +1,120 @@
+"""
+Minimal sd_notify implementation, a timer for the startup phases and the watchdog heartbeat, without depending on
+python-systemd.
+"""
+
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+def notify(*states: str) -> bool:
+    """
+    Send state changes like READY=1 to systemd, does nothing if not started by systemd
+    :param states:
+    :return: True if the message was sent
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        address = "\0" + address[1:]  # abstract namespace
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.sendto("\n".join(states).encode(), address)
+    except OSError as e:
+        logging.error(f"sd_notify failed: {e}")
+        return False
+    return True
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, started: float) -> None:
+        """
+        Record a startup phase that began at the given time.monotonic() value and ended now
+        :param name:
+        :param started:
+        :return:
+        """
+        with self.lock:
+            self.phases.append((name, time.monotonic() - started))
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def report(self) -> str:
+        with self.lock:
+            phases = ", ".join(f"{name} {duration * 1000:.0f}ms" for name, duration in self.phases)
+        return f"{phases} (total {self.elapsed() * 1000:.0f}ms)"
+
+
+def dumpStacks() -> None:
+    """
+    Log the current stack of every other thread
+    :return:
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident == threading.get_ident():
+            continue
+        logging.error(f"Thread {names.get(ident, ident)}:\n" + "".join(traceback.format_stack(frame)).rstrip())
+
+
+class Watchdog:
+    def __init__(self):
+        self.interval: float = 0
+        self.lastProgress: float = time.monotonic()
+        self.lastPing: float = 0
+        self.stalled = False
+        self.thread = None
+
+    def start(self, interval: float) -> None:
+        """
+        Set the watchdog interval of the service and start the stall detector
+        :param interval: seconds without progress before systemd restarts the service
+        :return:
+        """
+        self.interval = interval
+        self.lastProgress = time.monotonic()
+        notify(f"WATCHDOG_USEC={int(interval * 1000000)}")
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._detect, name="watchdog", daemon=True)
+            self.thread.start()
+
+    def progress(self) -> None:
+        """
+        The main loop did real work, only call this from the main loop
+        :return:
+        """
+        now = time.monotonic()
+        self.lastProgress = now
+        if self.stalled:
+            logging.warning("Main loop is making progress again")
+            self.stalled = False
+        if now - self.lastPing >= self.interval / 4:
+            self.lastPing = now
+            notify("WATCHDOG=1")
+
+    def _detect(self) -> None:
+        # warn at half the interval, so the stacks are in the log before systemd kills the process
+        while True:
+            time.sleep(self.interval / 4)
+            stalled = time.monotonic() - self.lastProgress
+            if stalled > self.interval / 2 and not self.stalled:
+                self.stalled = True
+                logging.error(f"Main loop made no progress for {stalled:.0f}s, stacks of all threads:")
+                dumpStacks()
+                notify("STATUS=Main loop stalled")
+
+
+TIMER = StartupTimer()
+WATCHDOG = Watchdog()
@@ -44,6 +44,7 @@ SENSORS = {
         "diagnostic": False,
         "type": hex,
         "convert": LINK_STATES,
+        "qos": 1,
     },
     "US attainable data rate": {
         "name": "Upstream Attainable Data Rate",
@@ -228,4 +229,85 @@ SENSORS = {
         "unit_of_measurement": "s",
         "internal": True,
     },
+}
+
+# sensors computed by the controller instead of parsed from the modem output, see timeline.py and throughput.py
+DERIVED_SENSORS = {
+    "Retrains 24h": {
+        "icon": "restart-alert",
+        "entity_category": "diagnostic",
+        "state_class": "measurement",
+        "unit_of_measurement": None,
+        "type": int,
+    },
+    "Time To Showtime": {
+        "icon": "timer-sand",
+        "entity_category": "diagnostic",
+        "device_class": "duration",
+        "unit_of_measurement": "s",
+        "type": int,
+    },
+    "Mean Time To Showtime": {
+        "icon": "timer-sand",
+        "entity_category": "diagnostic",
+        "device_class": "duration",
+        "unit_of_measurement": "s",
+        "type": int,
+    },
+    "Showtime Streak": {
+        "icon": "timer-outline",
+        "entity_category": "diagnostic",
+        "device_class": "duration",
+        "unit_of_measurement": "s",
+        "type": int,
+    },
+    "Longest Showtime Streak": {
+        "icon": "trophy-outline",
+        "entity_category": "diagnostic",
+        "device_class": "duration",
+        "unit_of_measurement": "s",
+        "type": int,
+    },
+    "ETH RX Rate": {
+        "icon": "download-network-outline",
+        "device_class": "data_rate",
+        "state_class": "measurement",
+        "unit_of_measurement": "kbit/s",
+        "type": float,
+    },
+    "ETH TX Rate": {
+        "icon": "upload-network-outline",
+        "device_class": "data_rate",
+        "state_class": "measurement",
+        "unit_of_measurement": "kbit/s",
+        "type": float,
+    },
+    "ETH RX Peak Rate": {
+        "icon": "download-network",
+        "entity_category": "diagnostic",
+        "device_class": "data_rate",
+        "state_class": "measurement",
+        "unit_of_measurement": "kbit/s",
+        "type": float,
+    },
+    "ETH TX Peak Rate": {
+        "icon": "upload-network",
+        "entity_category": "diagnostic",
+        "device_class": "data_rate",
+        "state_class": "measurement",
+        "unit_of_measurement": "kbit/s",
+        "type": float,
+    },
+    "DS Utilisation": {
+        "icon": "gauge",
+        "state_class": "measurement",
+        "unit_of_measurement": "%",
+        "type": float,
+    },
+    "US Utilisation": {
+        "icon": "gauge",
+        "state_class": "measurement",
+        "unit_of_measurement": "%",
+        "type": float,
+    },
 }
\ No newline at end of file
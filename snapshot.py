@@ -0,0 +1,174 @@
+"""
+Fixed-layout binary snapshot of the modem data in a memory-mapped file.
+
+The writer (the daemon) increments a sequence counter before and after every update. Readers copy the
+snapshot and retry if the counter was odd or changed while copying, so they always get a consistent view
+without taking any locks or doing any syscalls after the initial mmap. If the writer was killed in the middle
+of an update, the counter stays odd: after a short wait readers return the last copy marked as stale.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+from sensors import SENSORS, LINK_STATES
+
+SNAPSHOT_FILE = "snapshot.bin"
+STR_SIZE = 32
+
+# seq, number of fields, timestamp, modem available, link state
+HEADER = struct.Struct("<IIdII")
+SEQ = struct.Struct("<I")
+# retries without sleeping before readers back off
+SPIN = 100
+MAX_BACKOFF = 0.01
+
+
+def _layout() -> dict:
+    """
+    Compute the offset and format of every sensor in the snapshot, in the order of SENSORS
+    :return: {uid: (offset, struct, type)}
+    """
+    layout = {}
+    offset = HEADER.size
+    for linestart, sensor in SENSORS.items():
+        uid = (sensor.get("name") or linestart).replace(" ", "_").lower()
+        if sensor.get("type") is float:
+            fmt = struct.Struct("<d")
+        elif sensor.get("type") is str:
+            fmt = struct.Struct(f"<{STR_SIZE}s")
+        else:
+            fmt = struct.Struct("<q")
+        layout[uid] = (offset, fmt, sensor.get("type"))
+        offset += fmt.size
+    return layout
+
+
+LAYOUT = _layout()
+SIZE = max(offset + fmt.size for offset, fmt, _ in LAYOUT.values())
+
+
+class SnapshotWriter:
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self._map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        self._seq = 0
+        HEADER.pack_into(self._map, 0, self._seq, len(LAYOUT), time.time(), 0, 0)
+
+    def _begin(self) -> None:
+        self._seq += 1
+        SEQ.pack_into(self._map, 0, self._seq)
+
+    def _end(self) -> None:
+        self._seq += 1
+        SEQ.pack_into(self._map, 0, self._seq)
+
+    def _pack(self, uid: str, value) -> None:
+        offset, fmt, valuetype = LAYOUT[uid]
+        if valuetype is str:
+            fmt.pack_into(self._map, offset, str(value).encode()[:STR_SIZE])
+        else:
+            fmt.pack_into(self._map, offset, value)
+
+    def store(self, uid: str, value) -> None:
+        """
+        Update a single sensor value
+        :param uid:
+        :param value:
+        :return:
+        """
+        if uid not in LAYOUT:
+            return
+        self._begin()
+        self._pack(uid, value)
+        struct.pack_into("<d", self._map, 8, time.time())
+        self._end()
+
+    def setState(self, available: bool, trainingmode: int) -> None:
+        self._begin()
+        struct.pack_into("<dII", self._map, 8, time.time(), int(available), trainingmode)
+        self._end()
+
+    def clear(self) -> None:
+        """
+        Reset all sensor values, e.g. after the connection to the modem was lost
+        :return:
+        """
+        self._begin()
+        self._map[HEADER.size:SIZE] = bytes(SIZE - HEADER.size)
+        struct.pack_into("<dII", self._map, 8, time.time(), 0, 0)
+        self._end()
+
+    def close(self) -> None:
+        self._map.close()
+
+
+class SnapshotReader:
+    def __init__(self, path: str):
+        self.path = path
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+        if SEQ.unpack_from(self._map, 4)[0] != len(LAYOUT):
+            raise ValueError("Snapshot layout does not match sensors.py")
+
+    def read(self, timeout: float = 1) -> dict:
+        """
+        Returns a consistent copy of the latest modem data
+        :param timeout: seconds to wait for an update in progress
+        :return: with "stale": True if the writer was interrupted during an update
+        """
+        deadline = time.monotonic() + timeout
+        backoff = 0.0001
+        tries = 0
+        stale = False
+        lastseq = None
+        while True:
+            seq = SEQ.unpack_from(self._map, 0)[0]
+            data = self._map[:SIZE]
+            if not seq & 1 and SEQ.unpack_from(self._map, 0)[0] == seq:
+                break
+            tries += 1
+            if tries < SPIN:
+                lastseq = seq
+                continue
+            if time.monotonic() > deadline:
+                # an odd counter that doesn't change any more belongs to an interrupted writer
+                if seq & 1 and seq == lastseq:
+                    stale = True
+                    break
+                raise TimeoutError("Snapshot is updated too often to get a consistent copy")
+            lastseq = seq
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+        _, _, timestamp, available, trainingmode = HEADER.unpack_from(data, 0)
+        result = {
+            "timestamp": timestamp,
+            "modem_available": bool(available),
+            "stale": stale,
+        }
+        for uid, (offset, fmt, valuetype) in LAYOUT.items():
+            value = fmt.unpack_from(data, offset)[0]
+            if valuetype is str:
+                value = value.rstrip(b"\0").decode(errors="replace")
+            result[uid] = value
+        result["dsl_link_state"] = trainingmode
+        return result
+
+    def close(self) -> None:
+        self._map.close()
+
+
+if __name__ == "__main__":
+    reader = SnapshotReader(sys.argv[1] if len(sys.argv) > 1 else os.path.join("/run/dsl-modem", SNAPSHOT_FILE))
+    for key, val in reader.read().items():
+        if key == "dsl_link_state":
+            val = f"{LINK_STATES.get(val, 'unknown')} ({val:#06x})"
+        print(f"{key}: {val}")
@@ -0,0 +1,55 @@
+import socket
+import time
+
+from probe import Probe, Prober, RateLimiter, RttHistogram, UDP
+
+
+def _closedPort() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _probes(count: int, interval: float) -> list:
+    port = _closedPort()
+    return [Probe(f"Probe {number}", "127.0.0.1", method=UDP, port=port, interval=interval) for number in range(count)]
+
+
+def test_refused_probe_waits_for_next_token():
+    prober = Prober(_probes(8, interval=0), rate=2)
+    prober._probe()
+    prober.limiter.tokens = 0
+    now = time.monotonic()
+    prober._probe()
+    assert all(probe.nextProbe > now for probe in prober.probes)
+    for probe in prober.probes:
+        probe.close()
+
+
+def test_saturated_limiter_does_not_spin():
+    prober = Prober(_probes(8, interval=0.01), rate=5)
+    started, cpu = time.monotonic(), time.process_time()
+    prober.start()
+    time.sleep(1.5)
+    prober.stop()
+    elapsed, cpu = time.monotonic() - started, time.process_time() - cpu
+    sent = sum(probe.sequence for probe in prober.probes)
+    # burst of one token per probe plus the rate
+    assert sent <= 8 + 5 * elapsed + 1
+    assert cpu < 0.3 * elapsed
+
+
+def test_rate_limiter_delay():
+    limiter = RateLimiter(4, burst=1)
+    now = limiter.last
+    assert limiter.allow(now)
+    assert not limiter.allow(now)
+    assert abs(limiter.delay() - 0.25) < 1e-9
+
+
+def test_rtt_percentile_within_bucket_error():
+    histogram = RttHistogram()
+    for micros in range(1000, 101000, 100):
+        histogram.add(micros / 1000000)
+    exact = 0.099
+    assert exact <= histogram.percentile(99) <= exact * 1.125
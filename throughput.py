@@ -0,0 +1,112 @@
+"""
+Throughput of the ETH interface to the modem, from the statistics counters in sysfs.
+
+The counter files are opened once and read with pread, so a sample is four small reads and a few float
+operations. Received bytes are downstream traffic and sent bytes upstream traffic, rates are smoothed with an
+exponentially weighted moving average and compared with the DSL data rates to get the line utilisation.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+
+COUNTERS = ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets")
+# deltas that would mean more than this were an interface reset, not traffic
+MAX_RATE = 10 * 1000 * 1000 * 1000 / 8
+
+
+def counterDelta(old: int, new: int) -> int:
+    """
+    Increase of a counter that may have wrapped, 32 bit on 32 bit kernels and 64 bit otherwise
+    :param old:
+    :param new:
+    :return:
+    """
+    if new >= old:
+        return new - old
+    return new + (1 << 32 if old < 1 << 32 else 1 << 64) - old
+
+
+class ThroughputSampler:
+    def __init__(self, ethif: str, smoothing: float = 10, peaksmoothing: float = 1):
+        """
+        :param ethif: network interface
+        :param smoothing: time constant of the average rates in seconds
+        :param peaksmoothing: time constant of the short-term rates whose maximum is the peak rate
+        """
+        self.smoothing = smoothing
+        self.peaksmoothing = peaksmoothing
+        self.fds = {}
+        for counter in COUNTERS:
+            try:
+                self.fds[counter] = os.open(f"/sys/class/net/{ethif}/statistics/{counter}", os.O_RDONLY)
+            except OSError as e:
+                logging.warning(f"Throughput of {ethif} is not available: {e}")
+                self.close()
+                break
+        self.lock = threading.Lock()
+        self.last = None
+        self.lastTime: float = 0
+        self.packets = 0
+        # bytes per second, [rx, tx]
+        self.rate = [0.0, 0.0]
+        self.shortRate = [0.0, 0.0]
+        self.peak = [0.0, 0.0]
+
+    def _read(self) -> list:
+        return [int(os.pread(self.fds[counter], 32, 0)) for counter in COUNTERS]
+
+    def sample(self) -> None:
+        if not self.fds:
+            return
+        now = time.monotonic()
+        values = self._read()
+        self.packets = values[2] + values[3]
+        if self.last is None:
+            self.last, self.lastTime = values, now
+            return
+        elapsed = now - self.lastTime
+        if elapsed <= 0:
+            return
+        deltas = [counterDelta(old, new) for old, new in zip(self.last[:2], values[:2])]
+        self.last, self.lastTime = values, now
+        if any(delta > MAX_RATE * elapsed for delta in deltas):
+            logging.debug("Interface counters were reset")
+            return
+        alpha = 1 - math.exp(-elapsed / self.smoothing)
+        peakalpha = 1 - math.exp(-elapsed / self.peaksmoothing)
+        with self.lock:
+            for direction, delta in enumerate(deltas):
+                rate = delta / elapsed
+                self.rate[direction] += alpha * (rate - self.rate[direction])
+                self.shortRate[direction] += peakalpha * (rate - self.shortRate[direction])
+                self.peak[direction] = max(self.peak[direction], self.shortRate[direction])
+
+    def summary(self, dsrate: int = None, usrate: int = None) -> dict:
+        """
+        Rates in kbit/s and utilisation in percent of the DSL data rates, by uid. Resets the peak rates.
+        :param dsrate: current downstream data rate in kbit/s
+        :param usrate: current upstream data rate in kbit/s
+        :return:
+        """
+        if self.last is None:
+            return {}
+        with self.lock:
+            rx, tx = (rate * 8 / 1000 for rate in self.rate)
+            rxpeak, txpeak = (rate * 8 / 1000 for rate in self.peak)
+            self.peak = list(self.shortRate)
+        return {
+            "eth_rx_rate": round(rx, 1),
+            "eth_tx_rate": round(tx, 1),
+            "eth_rx_peak_rate": round(rxpeak, 1),
+            "eth_tx_peak_rate": round(txpeak, 1),
+            "ds_utilisation": round(rx / dsrate * 100, 1) if dsrate else None,
+            "us_utilisation": round(tx / usrate * 100, 1) if usrate else None,
+        }
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
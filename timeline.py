@@ -0,0 +1,117 @@
+"""
+Timeline of the DSL link state.
+
+Every change of the link state is timestamped and kept in a bounded index, together with the outages (from
+leaving showtime until showtime is reached again). From these the retrains of the last 24 hours, the time it
+took to get back to showtime and the showtime streaks are derived. A lost serial connection is recorded as an
+event of its own: the link state is unknown until the modem answers again, so it is neither a retrain nor part of
+an outage.
+"""
+
+import time
+from collections import deque
+
+from sensors import LINK_STATES
+
+SHOWTIME = (0x0800, 0x0801)
+DAY = 86400
+
+
+class LinkTimeline:
+    def __init__(self, maxevents: int = 500, maxoutages: int = 100):
+        """
+        :param maxevents: number of link state changes to keep
+        :param maxoutages: number of outages to keep
+        """
+        # (time, link state or None while the serial connection was lost)
+        self.events = deque(maxlen=maxevents)
+        # [start, time to showtime or None while the outage lasts, state the line dropped to]
+        self.outages = deque(maxlen=maxoutages)
+        self.retrains = deque()
+        self.state = None
+        self.showtimeSince: float = 0
+        self.longestStreak: float = 0
+
+    def observe(self, state: int, now: float = None) -> bool:
+        """
+        Record the current link state
+        :param state:
+        :param now:
+        :return: True if the state changed
+        """
+        if state == self.state:
+            return False
+        if now is None:
+            now = time.time()
+        wasShowtime = self.state in SHOWTIME
+        isShowtime = state in SHOWTIME
+        self.events.append((now, state))
+        if wasShowtime and not isShowtime:
+            self.longestStreak = max(self.longestStreak, now - self.showtimeSince)
+            self.showtimeSince = 0
+            self.retrains.append(now)
+            self.outages.append([now, None, state])
+        elif isShowtime and not wasShowtime:
+            self.showtimeSince = now
+            if self.outages and self.outages[-1][1] is None:
+                self.outages[-1][1] = now - self.outages[-1][0]
+        elif self.state is None:
+            # started while the line was down, the outage began before we know of it
+            self.outages.append([now, None, state])
+        self.state = state
+        return True
+
+    def lost(self, now: float = None) -> None:
+        """
+        The serial connection to the modem was lost, the link state is unknown from now on
+        :param now:
+        :return:
+        """
+        if self.state is None:
+            return
+        if now is None:
+            now = time.time()
+        self.events.append((now, None))
+        if self.state in SHOWTIME:
+            self.longestStreak = max(self.longestStreak, now - self.showtimeSince)
+            self.showtimeSince = 0
+        elif self.outages and self.outages[-1][1] is None:
+            # when the line got back to showtime is not known
+            self.outages.pop()
+        self.state = None
+
+    def retrainsToday(self, now: float) -> int:
+        while self.retrains and self.retrains[0] < now - DAY:
+            self.retrains.popleft()
+        return len(self.retrains)
+
+    def summary(self, now: float = None) -> dict:
+        """
+        Values of the derived sensors, by uid
+        :param now:
+        :return:
+        """
+        if now is None:
+            now = time.time()
+        streak = now - self.showtimeSince if self.showtimeSince else 0
+        recovered = [duration for _, duration, _ in self.outages if duration is not None]
+        return {
+            "retrains_24h": self.retrainsToday(now),
+            "time_to_showtime": round(recovered[-1]) if recovered else None,
+            "mean_time_to_showtime": round(sum(recovered) / len(recovered)) if recovered else None,
+            "showtime_streak": round(streak),
+            "longest_showtime_streak": round(max(self.longestStreak, streak)),
+        }
+
+    def recent(self, count: int = 10) -> list:
+        """
+        The last outages, newest first
+        :param count:
+        :return:
+        """
+        outages = list(self.outages)[-count:]
+        return [{
+            "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)),
+            "state": LINK_STATES.get(state, "unknown"),
+            "time_to_showtime": round(duration) if duration is not None else None,
+        } for start, duration, state in reversed(outages)]
@@ -0,0 +1,250 @@
+"""
+Per-tone capture of SNR, bit loading, QLN and Hlog.
+
+The tables are requested from the Lantiq DSL API over the console with dsl_cpe_pipe.sh, framed by echo
+markers. Each table is parsed into a NumPy array in one go and summarised per band (mean/min SNR, unloaded
+tones). The arrays are stored compressed, only the summaries are published.
+"""
+
+import logging
+import os
+import re
+import time
+
+np = None  # imported on first use, numpy takes a while to import on a Pi Zero
+
+MARKER_START = "@TONES "
+MARKER_END = "@TONES_END"
+
+# name: (command, decoder)
+TABLES = {
+    "ds_snr": ("dsl_cpe_pipe.sh g997sang 1", "snr"),
+    "us_snr": ("dsl_cpe_pipe.sh g997sang 0", "snr"),
+    "ds_bits": ("dsl_cpe_pipe.sh g997bang 1", "bits"),
+    "us_bits": ("dsl_cpe_pipe.sh g997bang 0", "bits"),
+    "ds_qln": ("dsl_cpe_pipe.sh g997dqlng 1 1", "qln"),
+    "ds_hlog": ("dsl_cpe_pipe.sh g997dhlogg 1 1", "hlog"),
+}
+
+# tones further apart than this belong to different bands
+BAND_GAP = 8
+
+re_groupsize = re.compile(r"nGroupSize=(\d+)")
+
+
+def _numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+
+def parseTable(lines: list, decoder: str) -> tuple:
+    """
+    Parse the output of a dsl_cpe_pipe.sh table command
+    :param lines: output lines, containing "nData=" followed by "(index,hexvalue)" pairs
+    :param decoder: snr, bits, qln or hlog
+    :return: (tones, values) as NumPy arrays, invalid values are NaN
+    """
+    np = _numpy()
+    text = " ".join(lines)
+    groupsize = re_groupsize.search(text)
+    groupsize = int(groupsize[1]) if groupsize else 1
+    start = text.find("nData=")
+    if start < 0:
+        raise ValueError("No data in table output")
+    tokens = text[start + 6:].translate(str.maketrans('(),"', "    ")).split()
+    if len(tokens) % 2:
+        tokens = tokens[:-1]
+    indices = np.array(tokens[0::2], dtype=np.int64) * groupsize
+    hexvalues = tokens[1::2]
+    width = len(hexvalues[0]) if hexvalues else 2
+    joined = "".join(hexvalues)
+    if width in (2, 4) and len(joined) == width * len(hexvalues):
+        raw = np.frombuffer(bytes.fromhex(joined), dtype=">u1" if width == 2 else ">u2")
+    else:
+        raw = np.array([int(value, 16) for value in hexvalues])
+    raw = raw.astype(np.float64)
+
+    if decoder == "snr":
+        values = np.where(raw == 255, np.nan, raw / 2 - 32)
+    elif decoder == "qln":
+        values = np.where(raw == 255, np.nan, -23 - raw / 2)
+    elif decoder == "hlog":
+        values = np.where(raw == 1023, np.nan, 6 - raw / 10)
+    else:
+        values = raw
+    return indices, values
+
+
+def bands(tones):
+    """
+    Split sorted tone indices into contiguous bands
+    :param tones:
+    :return: list of (first, last) tone
+    """
+    np = _numpy()
+    if not len(tones):
+        return []
+    breaks = np.flatnonzero(np.diff(tones) > BAND_GAP)
+    starts = np.concatenate(([tones[0]], tones[breaks + 1]))
+    ends = np.concatenate((tones[breaks], [tones[-1]]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def summarise(tables: dict, direction: str) -> dict:
+    """
+    Band-wise summary of SNR and bit loading for "ds" or "us"
+    :param tables: {name: (tones, values)}
+    :param direction:
+    :return:
+    """
+    np = _numpy()
+    summary = {"bands": []}
+    snr = tables.get(direction + "_snr")
+    bits = tables.get(direction + "_bits")
+    if snr is None:
+        return summary
+    tones, values = snr
+    valid = ~np.isnan(values)
+    tones, values = tones[valid], values[valid]
+    bitmap = None
+    if bits is not None:
+        bitmap = np.zeros(int(max(tones.max(initial=0), bits[0].max(initial=0))) + 1)
+        bitmap[bits[0]] = bits[1]
+    for first, last in bands(tones):
+        inband = (tones >= first) & (tones <= last)
+        band = {
+            "first_tone": first,
+            "last_tone": last,
+            "snr_mean": round(float(values[inband].mean()), 1),
+            "snr_min": round(float(values[inband].min()), 1),
+        }
+        if bitmap is not None:
+            loaded = bitmap[tones[inband]]
+            band["bits"] = int(loaded.sum())
+            band["unloaded_tones"] = int(np.count_nonzero(loaded == 0))
+        summary["bands"].append(band)
+    if len(values):
+        summary["snr_mean"] = round(float(values.mean()), 1)
+        summary["snr_min"] = round(float(values.min()), 1)
+    if bitmap is not None:
+        summary["bits"] = sum(band["bits"] for band in summary["bands"])
+        summary["unloaded_tones"] = sum(band["unloaded_tones"] for band in summary["bands"])
+    return summary
+
+
+class ToneCapture:
+    def __init__(self, directory: str, interval: float = 900, keep: int = 500):
+        """
+        :param directory: where the compressed arrays are stored
+        :param interval: seconds between captures
+        :param keep: number of captures to keep
+        """
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.nextCapture: float = time.time() + 60
+        self.started: float = 0
+        self.timeout: float = 120
+        self.active: bool = False
+        self.current = None
+        self.lines = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def prepare(self) -> bool:
+        """
+        Import numpy ahead of the first capture
+        :return: False if numpy is not available
+        """
+        try:
+            _numpy()
+        except ImportError:
+            logging.error("numpy is not installed, per-tone capture disabled")
+            return False
+        return True
+
+    def due(self) -> bool:
+        if self.active and self.started + self.timeout < time.time():
+            logging.warning("Tone capture timed out")
+            self.active = False
+            self.current = None
+            self.lines = {}
+        return not self.active and self.nextCapture <= time.time()
+
+    def command(self) -> bytes:
+        """
+        Returns the console commands to request all tables and starts the capture
+        :return:
+        """
+        self.active = True
+        self.started = time.time()
+        self.lines = {}
+        self.nextCapture = time.time() + self.interval
+        commands = [f'echo "{MARKER_START}{name}"; {command}; echo "{MARKER_END}"'
+                    for name, (command, _) in TABLES.items()]
+        return ("\n".join(commands) + f'\necho "{MARKER_START}done"\n').encode()
+
+    def feed(self, line: str) -> bool:
+        """
+        Collect output lines of the table commands
+        :param line:
+        :return: True if the line belonged to the capture, False if it wasn't consumed
+        """
+        if not self.active:
+            return False
+        if line.startswith(MARKER_START):
+            self.current = line[len(MARKER_START):].strip()
+            if self.current == "done":
+                self.current = None
+                self.active = False
+                return True
+            self.lines[self.current] = []
+        elif line.startswith(MARKER_END):
+            self.current = None
+        elif self.current is not None:
+            self.lines[self.current].append(line)
+        else:
+            return False
+        return True
+
+    def finished(self) -> bool:
+        return not self.active and bool(self.lines)
+
+    def take(self) -> dict:
+        """
+        Returns the collected output lines of a finished capture, to be processed in another thread
+        :return: {table name: lines}
+        """
+        lines, self.lines = self.lines, {}
+        return lines
+
+    def process(self, collected: dict) -> dict:
+        """
+        Parse the collected tables, store the arrays and return the summaries per direction
+        :param collected: {table name: lines}, see take()
+        :return:
+        """
+        np = _numpy()
+        tables = {}
+        for name, lines in collected.items():
+            try:
+                tables[name] = parseTable(lines, TABLES[name][1])
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Could not parse tone table {name}: {e}")
+
+        arrays = {}
+        for name, (tones, values) in tables.items():
+            arrays[name + "_tones"] = tones.astype(np.uint16)
+            arrays[name] = values.astype(np.float32)
+        if arrays:
+            np.savez_compressed(os.path.join(self.directory, f"tones-{int(time.time())}.npz"), **arrays)
+            self._prune()
+
+        return {direction: summarise(tables, direction) for direction in ("ds", "us")}
+
+    def _prune(self) -> None:
+        captures = sorted(name for name in os.listdir(self.directory) if name.startswith("tones-"))
+        for name in captures[:-self.keep]:
+            os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,168 @@
+"""
+Ring buffer of the raw bytes sent to and received from the modem, for post-mortem debugging.
+
+The ring lives in a memory-mapped file (in rundir, so on tmpfs), every read or write on the serial port is one
+record with timestamp and direction, copied in one slice assignment. On error paths the ring is frozen into a
+file that can be inspected with `python3 transcript.py <file>`. Only the copy of the ring is made by the caller,
+the file is written in the background. A ring left over from a crash is frozen as "previous" on startup.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b"DSLT"
+# magic, size of the ring, write position, wrapped
+HEADER = struct.Struct("<4sIII")
+# record marker, direction, length, timestamp
+RECORD = struct.Struct("<2scHd")
+RECORD_MARKER = b"\xa5\x5a"
+# longest data of one record, the length is an unsigned short
+MAX_RECORD = 0xffff
+RX = b"R"
+TX = b"T"
+
+
+class SerialTranscript:
+    def __init__(self, path: str, size: int = 256 * 1024, freezedir: str = None, freezeinterval: float = 60,
+                 keep: int = 20):
+        """
+        :param path: file for the ring buffer
+        :param size: size of the ring in bytes
+        :param freezedir: where frozen transcripts are stored, None disables freezing
+        :param freezeinterval: minimum seconds between two frozen transcripts
+        :param keep: number of frozen transcripts to keep
+        """
+        self.size = size
+        self.freezedir = freezedir
+        self.freezeinterval = freezeinterval
+        self.keep = keep
+        self.lastFreeze: float = 0
+        self.head = 0
+        self.wrapped = False
+        self.writers = []
+        if self.freezedir:
+            os.makedirs(self.freezedir, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            previous = self._previous(fd)
+            os.ftruncate(fd, HEADER.size + size)
+            self._map = mmap.mmap(fd, HEADER.size + size)
+        finally:
+            os.close(fd)
+        if previous:
+            # the service was restarted, maybe after a crash: that's the transcript worth keeping
+            self._save(previous, "previous")
+        HEADER.pack_into(self._map, 0, MAGIC, size, 0, 0)
+
+    def _previous(self, fd: int) -> bytes:
+        """
+        Content of a ring that was in use before
+        :param fd:
+        :return: None if there is none
+        """
+        if not self.freezedir:
+            return None
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return None
+        magic, size, head, wrapped = HEADER.unpack(header)
+        if magic != MAGIC or not (head or wrapped):
+            return None
+        return os.pread(fd, HEADER.size + size, 0)
+
+    def rx(self, data: bytes) -> None:
+        self._record(RX, data)
+
+    def tx(self, data: bytes) -> None:
+        self._record(TX, data)
+
+    def _record(self, direction: bytes, data: bytes) -> None:
+        data = data[:min(self.size - RECORD.size, MAX_RECORD)]
+        record = RECORD.pack(RECORD_MARKER, direction, len(data), time.time()) + data
+        start = HEADER.size + self.head
+        end = self.head + len(record)
+        if end <= self.size:
+            self._map[start:start + len(record)] = record
+        else:
+            first = self.size - self.head
+            self._map[start:HEADER.size + self.size] = record[:first]
+            self._map[HEADER.size:HEADER.size + len(record) - first] = record[first:]
+            self.wrapped = True
+        self.head = end % self.size
+        HEADER.pack_into(self._map, 0, MAGIC, self.size, self.head, self.wrapped)
+
+    def freeze(self, reason: str) -> str:
+        """
+        Save the current ring to a file
+        :param reason: short reason, becomes part of the filename
+        :return: filename or None if freezing is disabled or was done recently
+        """
+        if not self.freezedir or self.lastFreeze + self.freezeinterval > time.time():
+            return None
+        self.lastFreeze = time.time()
+        return self._save(self._map[:], reason)
+
+    def _save(self, content: bytes, reason: str) -> str:
+        filename = os.path.join(self.freezedir, time.strftime("transcript-%Y%m%d-%H%M%S-") + reason + ".bin")
+        writer = threading.Thread(target=self._write, args=(filename, content), name="TranscriptWriter")
+        writer.start()
+        self.writers = [thread for thread in self.writers if thread.is_alive()] + [writer]
+        return filename
+
+    def _write(self, filename: str, content: bytes) -> None:
+        try:
+            with open(filename, "wb") as f:
+                f.write(content)
+            logging.info(f"Saved serial transcript to {filename}")
+            frozen = sorted(name for name in os.listdir(self.freezedir) if name.startswith("transcript-"))
+            for name in frozen[:-self.keep]:
+                os.remove(os.path.join(self.freezedir, name))
+        except OSError as e:
+            logging.error(f"Could not save serial transcript: {e}")
+
+    def close(self) -> None:
+        for writer in self.writers:
+            writer.join(5)
+        self._map.close()
+
+
+def readTranscript(data: bytes) -> list:
+    """
+    Parse a ring buffer file
+    :param data: content of the file
+    :return: list of (timestamp, direction, data), oldest first
+    """
+    magic, size, head, wrapped = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a serial transcript")
+    ring = data[HEADER.size:HEADER.size + size]
+    ring = ring[head:] + ring[:head] if wrapped else ring[:head]
+
+    records = []
+    position = ring.find(RECORD_MARKER)
+    while 0 <= position <= len(ring) - RECORD.size:
+        marker, direction, length, timestamp = RECORD.unpack_from(ring, position)
+        end = position + RECORD.size + length
+        # the oldest record may have been partly overwritten, resynchronize on the next marker
+        if direction not in (RX, TX) or end > len(ring) or (end < len(ring) and not ring.startswith(RECORD_MARKER, end)):
+            position = ring.find(RECORD_MARKER, position + 1)
+            continue
+        records.append((timestamp, direction, ring[position + RECORD.size:end]))
+        position = end
+    return records
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <transcript file>")
+        sys.exit(1)
+    with open(sys.argv[1], "rb") as f:
+        content = f.read()
+    for recordtime, recorddirection, recorddata in readTranscript(content):
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(recordtime)) + f".{int(recordtime * 1000) % 1000:03d}",
+              "RX" if recorddirection == RX else "TX", repr(recorddata)[1:])
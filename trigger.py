@@ -0,0 +1,42 @@
+import time
+
+
+class CoalescingTrigger:
+    def __init__(self, leading: float = 0, spacing: float = 5, settle: float = 3):
+        """
+        Coalesces bursts of events into few refreshes: the first event after a quiet period triggers a refresh
+        after `leading` seconds, events during a storm are collapsed into one trailing refresh once no event was
+        seen for `settle` seconds. Refreshes are never closer together than `spacing` seconds.
+        :param leading: delay of the refresh for the first event
+        :param spacing: minimum time between two refreshes
+        :param settle: quiet time after the last event before the trailing refresh
+        """
+        self.leading = leading
+        self.spacing = spacing
+        self.settle = settle
+        self.lastEvent: float = 0
+        self.lastRun: float = 0
+        self.leadingAt: float = 0
+
+    def fire(self, now: float = None) -> None:
+        if now is None:
+            now = time.time()
+        if not self.leadingAt and self.lastEvent <= self.lastRun and now - self.lastRun >= self.spacing:
+            self.leadingAt = now + self.leading
+        self.lastEvent = now
+
+    def due(self, now: float) -> bool:
+        if now - self.lastRun < self.spacing:
+            return False
+        if self.leadingAt:
+            return now >= self.leadingAt
+        return self.lastEvent > self.lastRun and now >= self.lastEvent + self.settle
+
+    def ran(self, now: float) -> None:
+        """
+        A refresh was done, no matter what triggered it
+        :param now:
+        :return:
+        """
+        self.lastRun = now
+        self.leadingAt = 0